@@ -0,0 +1,187 @@
+import argparse
+import gc
+import importlib
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from ensemble import close_world, expand_grid, make_world, world_kwargs
+from profiling import Profiler
+
+ENGINE_MODULES = {"2d": "genezis", "3d": "genezis_3D", "vectorized": "population", "tiled": "tiles"}
+
+
+def profile_phases(engine):
+    return importlib.import_module(ENGINE_MODULES[engine]).PROFILE_PHASES
+
+
+def build_world(engine, organisms, size, params, seed):
+    kwargs = world_kwargs(params)
+    kwargs.update(width=size, height=size, initial_organisms=organisms)
+    if engine != "2d":
+        kwargs["depth"] = size
+    return make_world(engine, seed, kwargs)
+
+
+def run_ticks(step, ticks, max_seconds):
+    # Stops early once max_seconds have passed, after at least one tick
+    done = 0
+    started = time.perf_counter()
+    while done < ticks:
+        step()
+        done += 1
+        if time.perf_counter() - started > max_seconds:
+            break
+    return done, time.perf_counter() - started
+
+
+def run_case(engine, organisms, size, params, seed, ticks, max_seconds, phases=True):
+    gc.collect()
+    started = time.perf_counter()
+    world, step = build_world(engine, organisms, size, params, seed)
+    try:
+        build_seconds = time.perf_counter() - started
+        ticks, elapsed = run_ticks(step, ticks, max_seconds)
+        result = {
+            "engine": engine, "organisms": organisms, "size": size, "params": params, "seed": seed, "ticks": ticks,
+            "build_seconds": round(build_seconds, 4),
+            "ticks_per_second": round(ticks / elapsed, 3),
+            "final_organisms": len(world.organisms),
+        }
+    finally:
+        close_world(world)
+    del world, step
+
+    if phases:
+        # Same seed and tick count again, once with the phase timers on and
+        # once under tracemalloc, which slows everything down too much to
+        # share a pass with the timers
+        gc.collect()
+        with Profiler(profile_phases(engine)) as profiler:
+            world, step = build_world(engine, organisms, size, params, seed)
+            try:
+                profiler.reset()
+                for _ in range(ticks):
+                    step()
+            finally:
+                close_world(world)
+        stats = profiler.stats()
+        result["phase_ms_per_tick"] = {phase: round(ms_per_tick, 4) for phase, (_, _, ms_per_tick) in stats.items()}
+        result["phase_calls_per_tick"] = {phase: round(calls / ticks, 1) for phase, (_, calls, _) in stats.items()}
+        del world, step
+
+        gc.collect()
+        tracemalloc.start()
+        world, step = build_world(engine, organisms, size, params, seed)
+        try:
+            for _ in range(ticks):
+                step()
+            result["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        finally:
+            tracemalloc.stop()
+            close_world(world)
+    return result
+
+
+def case_key(result):
+    return (result["engine"], result["organisms"], result["size"], json.dumps(result["params"], sort_keys=True),
+            result["seed"])
+
+
+def environment():
+    import numpy
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "numpy": numpy.__version__,
+            "machine": platform.machine(), "platform": platform.platform(),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+
+def run_suite(engines, populations, sizes, grid, seed, ticks, max_seconds, phases=True, out=None):
+    suite = {"environment": environment(), "results": []}
+    for engine in engines:
+        for size in sizes:
+            for params in expand_grid(grid):
+                for organisms in populations:
+                    result = run_case(engine, organisms, size, params, seed, ticks, max_seconds, phases)
+                    suite["results"].append(result)
+                    print(format_result(result), flush=True)
+                    if out:
+                        # Rewritten after every case, so a long sweep can be stopped at any point
+                        with open(out, "w") as f:
+                            json.dump(suite, f, indent=1)
+    return suite
+
+
+def format_result(result):
+    params = " ".join(f"{key}={value}" for key, value in result["params"].items())
+    line = (f"{result['engine']:>10} {result['organisms']:>7} organisms  size {result['size']:<5} {params:<24}"
+            f"{result['ticks_per_second']:>10.1f} ticks/s  ({result['ticks']} ticks)")
+    if "phase_ms_per_tick" in result:
+        phases = sorted(result["phase_ms_per_tick"].items(), key=lambda item: -item[1])
+        line += f"  {result['peak_memory_mb']:>8.1f} MB  " + ", ".join(f"{phase} {ms:.3f}ms" for phase, ms in phases)
+    return line
+
+
+def compare(base_path, new_path):
+    with open(base_path) as f:
+        base = {case_key(result): result for result in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    rows = []
+    for result in new:
+        before = base.get(case_key(result))
+        if before is None:
+            continue
+        speedup = result["ticks_per_second"] / before["ticks_per_second"]
+        memory = ""
+        if "peak_memory_mb" in result and "peak_memory_mb" in before and before["peak_memory_mb"]:
+            memory = f"{result['peak_memory_mb'] / before['peak_memory_mb']:.2f}x memory"
+        rows.append((result, speedup))
+        print(f"{result['engine']:>10} {result['organisms']:>7} organisms  size {result['size']:<5} "
+              f"{before['ticks_per_second']:>10.1f} -> {result['ticks_per_second']:>10.1f} ticks/s  "
+              f"{speedup:.2f}x  {memory}")
+    return rows
+
+
+def parse_ints(text):
+    return [int(float(value)) for value in text.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="benchmark", description="Measure tick throughput of the world engines")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmark sweep")
+    run.add_argument("--engines", default="2d,3d,vectorized")
+    run.add_argument("--organisms", default="20,100,1000,10000,100000", help="population sizes, e.g. 20,1e3,1e5")
+    run.add_argument("--sizes", default="400", help="world side lengths")
+    run.add_argument("--grid", default="{}",
+                     help='JSON object of further GameWorld arguments to lists of values, '
+                          'e.g. \'{"query_cell_size": [16, 32, 64]}\'')
+    run.add_argument("--seed", type=int, default=1)
+    run.add_argument("--ticks", type=int, default=100)
+    run.add_argument("--max-seconds", type=float, default=20, help="stop a case early after this long")
+    run.add_argument("--no-phases", dest="phases", action="store_false",
+                     help="skip the instrumented passes (phase times and peak memory)")
+    run.add_argument("--out", help="save the results as JSON")
+
+    diff = commands.add_parser("compare", help="compare two saved result files")
+    diff.add_argument("base")
+    diff.add_argument("new")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run_suite(args.engines.split(","), parse_ints(args.organisms), parse_ints(args.sizes), json.loads(args.grid),
+                  args.seed, args.ticks, args.max_seconds, args.phases, args.out)
+    else:
+        compare(args.base, args.new)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import argparse
+import json
+import sqlite3
+import time
+
+from ensemble import COUNTERS, read_results, run_id
+
+# Telemetry tick counters kept in the time series of a run; engines that don't report one leave it empty
+SERIES_FIELDS = ["organisms", "food", "dead_organisms", "dead_by_attack", "dead_by_starvation"]
+
+RUN_FIELDS = ["run_key", "engine", "seed", "ticks", "params", "population", "food", *COUNTERS, "dead_colors",
+              "extinct", "extinct_tick", "elapsed", "created"]
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    run_key TEXT UNIQUE NOT NULL,
+    engine TEXT NOT NULL,
+    seed INTEGER,
+    ticks INTEGER NOT NULL,
+    params TEXT NOT NULL,
+    population INTEGER,
+    food INTEGER,
+    {", ".join(f"{counter} INTEGER" for counter in COUNTERS)},
+    dead_colors TEXT,
+    extinct INTEGER,
+    extinct_tick INTEGER,
+    elapsed REAL,
+    created TEXT
+);
+CREATE TABLE IF NOT EXISTS params (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    value
+);
+CREATE TABLE IF NOT EXISTS series (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    tick INTEGER NOT NULL,
+    {", ".join(f"{name} INTEGER" for name in SERIES_FIELDS)},
+    PRIMARY KEY (run, tick)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS params_by_value ON params(name, value, run);
+CREATE INDEX IF NOT EXISTS params_by_run ON params(run);
+CREATE INDEX IF NOT EXISTS runs_by_outcome ON runs(extinct, population);
+CREATE INDEX IF NOT EXISTS runs_by_extinct_tick ON runs(extinct_tick);
+CREATE INDEX IF NOT EXISTS runs_by_seed ON runs(engine, seed);
+"""
+
+
+def flat_params(params):
+    # Parameter rows of a run: every value as it was given (lists as JSON),
+    # plus one row per element of a list, so "trait_ranges.speed": [2, 7]
+    # can be matched whole or as trait_ranges.speed[0] and [1]
+    rows = []
+    for name, value in sorted(params.items()):
+        if isinstance(value, (list, tuple)):
+            rows.append((name, json.dumps(value)))
+            rows.extend((f"{name}[{i}]", item) for i, item in enumerate(value))
+        elif isinstance(value, dict):
+            rows.append((name, json.dumps(value, sort_keys=True)))
+        else:
+            rows.append((name, value))
+    return rows
+
+
+def number(value):
+    # Plain Python numbers for sqlite3, which can't bind NumPy scalars
+    return value.item() if hasattr(value, "item") else value
+
+
+def series_row(row):
+    # One telemetry tick row as a series entry
+    return [number(row["tick"]), *(number(row.get(name)) for name in SERIES_FIELDS)]
+
+
+class Catalog:
+    # Runs stored in one SQLite file: parameters, seed, final counters and a
+    # sampled population time series per run. Runs are added in batches,
+    # each in one transaction with executemany, and indexed by parameter
+    # value and by outcome, so questions over thousands of runs are a single
+    # query. A run is known by the same key as in ensemble results and is
+    # never stored twice.
+
+    def __init__(self, path="runs.sqlite"):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def add(self, runs):
+        # runs: dicts with run_id, engine, seed, ticks and params (a dict),
+        # final population, food and counters, and optionally elapsed,
+        # dead_colors and series (telemetry tick rows); as from
+        # ensemble.run_one. Returns how many were new.
+        runs = list(runs)
+        known = self.known(run["run_id"] for run in runs)
+        created = time.strftime("%Y-%m-%d %H:%M:%S")
+        params = []
+        series = []
+        added = 0
+        with self.db:
+            for run in runs:
+                if run["run_id"] in known:
+                    continue
+                known.add(run["run_id"])
+                rows = [series_row(row) for row in run.get("series", ())]
+                # A run that doesn't carry its extinction tick gets the first sampled one
+                extinct_tick = run.get("extinct_tick",
+                                       next((row[0] for row in rows if row[1] == 0), None))
+                values = [run["run_id"], run["engine"], run.get("seed"), run["ticks"],
+                          json.dumps(run["params"], sort_keys=True), number(run.get("population")),
+                          number(run.get("food")), *(number(run.get(counter)) for counter in COUNTERS),
+                          json.dumps(run.get("dead_colors")) if run.get("dead_colors") is not None else None,
+                          None if run.get("population") is None else int(run["population"]) == 0,
+                          extinct_tick, run.get("elapsed"), created]
+                cursor = self.db.execute(f"INSERT INTO runs ({', '.join(RUN_FIELDS)}) "
+                                         f"VALUES ({', '.join('?' * len(RUN_FIELDS))})", values)
+                row_id = cursor.lastrowid
+                params.extend((row_id, name, value) for name, value in flat_params(run["params"]))
+                series.extend([row_id, *row] for row in rows)
+                added += 1
+            self.db.executemany("INSERT INTO params (run, name, value) VALUES (?, ?, ?)", params)
+            self.db.executemany(f"INSERT INTO series (run, tick, {', '.join(SERIES_FIELDS)}) "
+                                f"VALUES ({', '.join('?' * (len(SERIES_FIELDS) + 2))})", series)
+        return added
+
+    def known(self, run_ids):
+        # The run ids among run_ids that are stored already
+        run_ids = list(run_ids)
+        found = set()
+        for first in range(0, len(run_ids), 500):
+            chunk = run_ids[first:first + 500]
+            found.update(key for key, in self.db.execute(
+                f"SELECT run_key FROM runs WHERE run_key IN ({', '.join('?' * len(chunk))})", chunk))
+        return found
+
+    def query(self, sql, args=()):
+        return self.db.execute(sql, args).fetchall()
+
+    def outcomes(self, name, **where):
+        # Runs, extinctions, mean final population and mean tick of
+        # extinction per value of parameter `name` (e.g. "trait_ranges.speed"
+        # or "food_regrowth"), optionally only among runs whose other
+        # parameters have the given values: outcomes("food_regrowth", engine="3d")
+        sql = ("SELECT p.value, COUNT(*), SUM(r.extinct), AVG(r.population), AVG(r.extinct_tick) "
+               "FROM params p JOIN runs r ON r.id = p.run WHERE p.name = ?")
+        args = [name]
+        for key, value in sorted(where.items()):
+            if key in ("engine", "seed", "ticks"):
+                sql += f" AND r.{key} = ?"
+                args.append(value)
+            else:
+                sql += " AND EXISTS (SELECT 1 FROM params q WHERE q.run = r.id AND q.name = ? AND q.value = ?)"
+                args.extend([key, json.dumps(value) if isinstance(value, (list, tuple)) else value])
+        return self.query(sql + " GROUP BY p.value ORDER BY p.value", args)
+
+    def series(self, run_key):
+        return self.query(f"SELECT tick, {', '.join(SERIES_FIELDS)} FROM series s JOIN runs r ON r.id = s.run "
+                          "WHERE r.run_key = ? ORDER BY tick", [run_key])
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+def add_world(path, world, engine, params, seed, ticks, elapsed=None, series=(), extinct_tick=None):
+    # Stores a finished headless run (genezis run --catalog). A run without a
+    # seed or continued from a snapshot isn't told apart by its parameters,
+    # so its key also holds the time it finished.
+    key = run_id(engine, params, seed, ticks)
+    if seed is None or "restore" in params:
+        key += time.strftime(" at %Y-%m-%d %H:%M:%S")
+    colors = getattr(world, "dead_colors_counter", None)
+    run = {"run_id": key, "engine": engine, "seed": seed, "ticks": ticks, "params": params,
+           "population": len(world.organisms), "food": len(world.food), "extinct_tick": extinct_tick,
+           "elapsed": elapsed, "series": series,
+           "dead_colors": {str(color): count for color, count in colors.items()} if colors is not None else None}
+    run.update((counter, getattr(world, counter, 0)) for counter in COUNTERS)
+    catalog = Catalog(path)
+    try:
+        return catalog.add([run])
+    finally:
+        catalog.close()
+
+
+def csv_runs(path):
+    # Results of ensemble.run_ensemble as runs for Catalog.add; the columns
+    # between ticks and population are the sweep's parameters
+    for row in read_results(path):
+        fields = list(row)
+        params = {key: json.loads(row[key]) for key in fields[fields.index("ticks") + 1:fields.index("population")]}
+        run = {"run_id": row["run_id"], "engine": row["engine"], "seed": int(row["seed"]),
+               "ticks": int(row["ticks"]), "params": params, "elapsed": float(row["elapsed"])}
+        run.update((key, int(row[key])) for key in ["population", "food", *COUNTERS])
+        if "extinct_tick" in row:
+            run["extinct_tick"] = int(row["extinct_tick"]) if row["extinct_tick"] else None
+        yield run
+
+
+def print_rows(rows):
+    for row in rows:
+        print("\t".join("" if value is None else str(value) for value in row))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="catalog", description="Store and query simulation runs in SQLite")
+    parser.add_argument("--db", default="runs.sqlite")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    load = commands.add_parser("import", help="add the runs of ensemble result files")
+    load.add_argument("csv", nargs="+")
+
+    outcomes = commands.add_parser("outcomes", help="runs, extinctions, mean population and extinction tick "
+                                                    "per value of a parameter")
+    outcomes.add_argument("param", help='e.g. food_regrowth or "trait_ranges.speed"')
+
+    sql = commands.add_parser("query", help="run an SQL statement against the catalog")
+    sql.add_argument("sql")
+
+    args = parser.parse_args(argv)
+    catalog = Catalog(args.db)
+    try:
+        if args.command == "import":
+            for path in args.csv:
+                print(f"{path}: {catalog.add(csv_runs(path))} new runs")
+        elif args.command == "outcomes":
+            print("value\truns\textinct\tpopulation\textinct_tick")
+            print_rows(catalog.outcomes(args.param))
+        else:
+            print_rows(catalog.query(args.sql))
+    finally:
+        catalog.close()
+
+
+if __name__ == "__main__":
+    main()
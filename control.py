@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import numpy as np
+
+from ensemble import COUNTERS, make_world, parse_seeds, world_kwargs
+
+
+class HostedWorld:
+    # One world run by a Controller. Its task steps the world for at most
+    # `slice_seconds` at a time and then yields to the event loop, so any
+    # number of worlds, their commands and the metrics streams share one
+    # thread. `rate` caps its ticks per second; None runs it as fast as its
+    # share of the loop allows.
+
+    def __init__(self, name, engine="3d", seed=None, params=None, rate=None, slice_seconds=0.02):
+        self.name = name
+        self.engine = engine
+        self.seed = seed
+        self.params = params or {}
+        self.rate = rate
+        self.slice_seconds = slice_seconds
+        self.world, self.step = make_world(engine, seed, world_kwargs(self.params))
+        self.paused = False
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        # Draws the cells and positions of injected food, so the world's own random stream is untouched
+        self.rng = random.Random(seed)
+        self.task = None
+        self.ticks_per_second = 0.0
+        # What stopped the world when a tick raised, reported by metrics()
+        self.error = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run(), name=self.name)
+        return self
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.resumed.wait()
+            started = loop.time()
+            try:
+                done = self.advance(None if self.rate is None else max(1, round(self.rate * self.slice_seconds)))
+            except Exception as error:
+                self.fail(error)
+                continue
+            delay = done / self.rate - (loop.time() - started) if self.rate else 0
+            await asyncio.sleep(max(0.0, delay))
+            self.ticks_per_second = done / (loop.time() - started)
+
+    def advance(self, ticks=None):
+        # Up to `ticks` ticks (at least one), stopping when the slice is used up
+        started = time.perf_counter()
+        done = 0
+        while ticks is None or done < ticks:
+            self.step()
+            done += 1
+            if time.perf_counter() - started >= self.slice_seconds:
+                break
+        return done
+
+    async def step_ticks(self, ticks):
+        # Runs `ticks` ticks now, paused or not, yielding between slices
+        if self.error:
+            raise ValueError(f"world {self.name!r} stopped: {self.error}")
+        done = 0
+        while done < ticks:
+            try:
+                done += self.advance(ticks - done)
+            except Exception as error:
+                self.fail(error)
+                raise ValueError(f"world {self.name!r} stopped: {self.error}")
+            await asyncio.sleep(0)
+        return done
+
+    def fail(self, error):
+        # A world whose tick raised stays paused, with the error in its
+        # metrics, until it is restarted
+        self.error = f"{type(error).__name__}: {error}"
+        self.pause()
+
+    def pause(self):
+        self.paused = True
+        self.resumed.clear()
+
+    def resume(self):
+        if self.error:
+            return
+        self.paused = False
+        self.resumed.set()
+
+    def restart(self, seed=None):
+        # A 3D world starts over in place (GameWorld.restart_world); any other
+        # world, or any world given a new seed, is built again
+        if self.error:
+            self.error = None
+            self.resume()
+        if seed is None and hasattr(self.world, "restart_world"):
+            self.world.restart_world()
+            return
+        if seed is not None:
+            self.seed = seed
+            self.rng = random.Random(seed)
+        self.close()
+        self.world, self.step = make_world(self.engine, self.seed, world_kwargs(self.params))
+
+    def add_food(self, count=1, position=None, radius=None):
+        # `count` portions of food at random, or within `radius` of
+        # `position`; a portion is a full food cell, or one item in 2D
+        world = self.world
+        if self.engine == "2d":
+            low, high = self.bounds(position, radius, (world.width, world.height))
+            for _ in range(count):
+                world.add_food(*(self.rng.randint(a, b) for a, b in zip(low, high)))
+            return count
+        shape = world.food.shape
+        size = world.food.cell_size
+        low, high = self.bounds(position, radius, [n * size for n in shape])
+        cells = [range(int(a // size), min(n, int(b // size) + 1)) for a, b, n in zip(low, high, shape)]
+        choices = len(cells[0]) * len(cells[1]) * len(cells[2])
+        picked = self.rng.sample(range(choices), min(count, choices))
+        world.add_food(np.stack(np.unravel_index(picked, [len(axis) for axis in cells]), axis=1)
+                       + [axis.start for axis in cells])
+        return len(picked)
+
+    def bounds(self, position, radius, size):
+        # Lowest and highest coordinate inside the world and the box around position
+        if position is None:
+            return [0] * len(size), [side - 1 for side in size]
+        return ([max(0, int(c - radius)) for c, side in zip(position, size)],
+                [min(side - 1, int(c + radius)) for c, side in zip(position, size)])
+
+    def metrics(self):
+        world = self.world
+        row = {"world": self.name, "engine": self.engine, "seed": self.seed, "tick": world.ticks,
+               "paused": self.paused, "ticks_per_second": round(self.ticks_per_second, 1), "error": self.error}
+        last = world.telemetry.tick_rows[-1] if world.telemetry.tick_rows else {}
+        for name, value in last.items():
+            if name != "tick":
+                row[name] = value.item() if hasattr(value, "item") else value
+        for counter in COUNTERS:
+            if hasattr(world, counter):
+                row[counter] = int(getattr(world, counter))
+        return row
+
+    def close(self):
+        if hasattr(self.world, "close"):
+            self.world.close()
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self.close()
+
+
+class Controller:
+    # Hosts many HostedWorlds on one event loop and carries out the commands
+    # of the control protocol: every request is a JSON object with a
+    # "command" and its arguments, and "world" picks one world by name
+    # (every world if left out). See serve() for the socket side.
+
+    def __init__(self):
+        self.worlds = {}
+
+    def add(self, name, engine="3d", seed=None, params=None, rate=None):
+        if name in self.worlds:
+            raise ValueError(f"world {name!r} exists already")
+        self.worlds[name] = HostedWorld(name, engine, seed, params, rate).start()
+        return self.worlds[name]
+
+    async def remove(self, name):
+        hosted, = self.select(name)
+        del self.worlds[name]
+        await hosted.stop()
+
+    def select(self, name=None):
+        if name is None:
+            return list(self.worlds.values())
+        if name not in self.worlds:
+            raise ValueError(f"no world {name!r}")
+        return [self.worlds[name]]
+
+    def metrics(self, name=None):
+        return [hosted.metrics() for hosted in self.select(name)]
+
+    async def execute(self, request):
+        command = request.get("command")
+        name = request.get("world")
+        if command == "list":
+            return {"worlds": self.metrics()}
+        if command == "metrics":
+            return {"metrics": self.metrics(name)}
+        if command in ("add", "remove") and name is None:
+            raise ValueError(f"{command} needs a world name")
+        if command == "add":
+            hosted = self.add(name, request.get("engine", "3d"), request.get("seed"), request.get("params"),
+                              request.get("rate"))
+            return {"metrics": [hosted.metrics()]}
+        if command == "remove":
+            await self.remove(name)
+            return {}
+        worlds = self.select(name)
+        if command == "pause":
+            for hosted in worlds:
+                hosted.pause()
+        elif command == "resume":
+            for hosted in worlds:
+                hosted.resume()
+        elif command == "step":
+            for hosted in worlds:
+                await hosted.step_ticks(request.get("ticks", 1))
+        elif command == "restart":
+            for hosted in worlds:
+                hosted.restart(request.get("seed"))
+        elif command == "food":
+            added = {hosted.name: hosted.add_food(request.get("count", 1), request.get("position"),
+                                                  request.get("radius", 0))
+                     for hosted in worlds}
+            return {"added": added, "metrics": self.metrics(name)}
+        elif command == "rate":
+            for hosted in worlds:
+                hosted.rate = request.get("rate")
+        else:
+            raise ValueError(f"unknown command {command!r}")
+        return {"metrics": self.metrics(name)}
+
+    async def handle(self, reader, writer):
+        # One client: a JSON request per line, a JSON reply per line.
+        # "subscribe" turns the connection into a metrics stream, one line
+        # every `interval` seconds, until the client goes away.
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    if request.get("command") == "subscribe":
+                        await self.stream(writer, request.get("world"), request.get("interval", 1.0))
+                        return
+                    reply = dict(ok=True, **await self.execute(request))
+                except (ValueError, KeyError, TypeError, AttributeError, NotImplementedError) as error:
+                    reply = {"ok": False, "error": str(error)}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def stream(self, writer, name, interval):
+        while True:
+            writer.write(json.dumps({"time": round(time.time(), 3), "metrics": self.metrics(name)}).encode() + b"\n")
+            await writer.drain()
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        for name in list(self.worlds):
+            await self.remove(name)
+
+
+async def start_server(controller, port=None, path=None):
+    # Only local clients: a TCP port on 127.0.0.1, or a Unix socket at path
+    if path:
+        return await asyncio.start_unix_server(controller.handle, path)
+    return await asyncio.start_server(controller.handle, "127.0.0.1", port)
+
+
+async def serve(worlds, port=None, path=None):
+    # worlds: add() arguments of the worlds to start with
+    controller = Controller()
+    for world in worlds:
+        controller.add(**world)
+    server = await start_server(controller, port, path)
+    print(f"{len(controller.worlds)} worlds, listening on {path or f'127.0.0.1:{port}'}", flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await controller.close()
+
+
+async def connect(port=None, path=None):
+    if path:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection("127.0.0.1", port)
+
+
+async def send(request, port=None, path=None):
+    reader, writer = await connect(port, path)
+    writer.write(json.dumps(request).encode() + b"\n")
+    await writer.drain()
+    reply = json.loads(await reader.readline())
+    writer.close()
+    return reply
+
+
+async def watch(request, port=None, path=None):
+    reader, writer = await connect(port, path)
+    writer.write(json.dumps(dict(request, command="subscribe")).encode() + b"\n")
+    await writer.drain()
+    while line := await reader.readline():
+        for row in json.loads(line)["metrics"]:
+            print(" ".join(f"{key}={value}" for key, value in row.items()), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="control", description="Host headless worlds and control them over a "
+                                                                  "local socket")
+    parser.add_argument("--port", type=int, default=8765, help="TCP port on 127.0.0.1")
+    parser.add_argument("--socket", metavar="PATH", help="use a Unix socket instead of the TCP port")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    host = commands.add_parser("serve", help="run worlds until interrupted")
+    host.add_argument("--engine", choices=["2d", "3d", "vectorized", "tiled"], default="3d")
+    host.add_argument("--seeds", default="1", help="one world per seed, e.g. 1-8")
+    host.add_argument("--params", default="{}", help="JSON object of world arguments, as in an ensemble grid entry")
+    host.add_argument("--rate", type=float, help="ticks per second of each world (default: as fast as possible)")
+
+    request = commands.add_parser("send", help='send one request, e.g. send \'{"command": "pause", "world": "w1"}\'')
+    request.add_argument("request")
+
+    stream = commands.add_parser("watch", help="print the metrics of every world (or one) as they stream in")
+    stream.add_argument("--world")
+    stream.add_argument("--interval", type=float, default=1.0)
+
+    args = parser.parse_args(argv)
+    try:
+        if args.command == "serve":
+            params = json.loads(args.params)
+            worlds = [dict(name=f"w{seed}", engine=args.engine, seed=seed, params=params, rate=args.rate)
+                      for seed in parse_seeds(args.seeds)]
+            asyncio.run(serve(worlds, args.port, args.socket))
+        elif args.command == "send":
+            print(json.dumps(asyncio.run(send(json.loads(args.request), args.port, args.socket))))
+        else:
+            asyncio.run(watch({"world": args.world, "interval": args.interval}, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+COUNTERS = ["dead_organisms_count", "dead_by_attack_count", "dead_by_starvation_count"]
+
+
+def make_world(engine, seed, kwargs):
+    # Returns the world and the function that advances it by one tick
+    if engine == "2d":
+        import genezis
+        world = genezis.GameWorld(seed=seed, **kwargs)
+        return world, world.tick
+    if engine == "3d":
+        import genezis_3D
+        world = genezis_3D.GameWorld(seed=seed, **kwargs)
+        return world, world.tick
+    if engine == "vectorized":
+        from population import VectorGameWorld
+        world = VectorGameWorld(seed=seed, **kwargs)
+        return world, world.tick
+    if engine == "tiled":
+        from tiles import TiledWorld
+        world = TiledWorld(seed=seed, **kwargs)
+        return world, world.tick
+    raise ValueError(f"unknown engine {engine!r}")
+
+
+def close_world(world):
+    # A tiled world's worker processes only stop when it is closed
+    if hasattr(world, "close"):
+        world.close()
+
+
+def expand_grid(grid):
+    # {"a": [1, 2], "b": [3]} -> [{"a": 1, "b": 3}, {"a": 2, "b": 3}]
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def world_kwargs(params):
+    # A dotted key sets one entry of a dict argument: "trait_ranges.speed": [2, 7]
+    kwargs = {}
+    for key, value in params.items():
+        name, _, field = key.partition(".")
+        if field:
+            kwargs.setdefault(name, {})[field] = value
+        else:
+            kwargs[name] = value
+    return kwargs
+
+
+def run_id(engine, params, seed, ticks):
+    return f"{engine} {json.dumps(params, sort_keys=True)} seed={seed} ticks={ticks}"
+
+
+def run_one(engine, params, seed, ticks, series_every=0):
+    # One result row; with series_every, also the telemetry counters of
+    # every series_every-th tick under "series" for a catalog.Catalog
+    started = time.perf_counter()
+    world, step = make_world(engine, seed, world_kwargs(params))
+    series = []
+    extinct_tick = None
+    try:
+        for _ in range(ticks):
+            step()
+            rows = world.telemetry.tick_rows
+            if series_every and rows and rows[-1]["tick"] % series_every == 0:
+                series.append(rows[-1])
+            extinct_tick = extinction(rows, extinct_tick)
+        population = len(world.organisms)
+    finally:
+        close_world(world)
+
+    row = {"run_id": run_id(engine, params, seed, ticks), "engine": engine, "seed": seed, "ticks": ticks}
+    row.update((key, json.dumps(value)) for key, value in params.items())
+    row["population"] = population
+    row["food"] = len(world.food)
+    for counter in COUNTERS:
+        row[counter] = getattr(world, counter, 0)
+    row["extinct_tick"] = extinct_tick
+    row["elapsed"] = round(time.perf_counter() - started, 3)
+    # Not written to the CSV file
+    row["params"] = params
+    row["series"] = series
+    colors = getattr(world, "dead_colors_counter", None)
+    row["dead_colors"] = {str(color): count for color, count in colors.items()} if colors is not None else None
+    return row
+
+
+def extinction(rows, extinct_tick):
+    # The tick the population died out, from the telemetry row of the tick just run
+    if extinct_tick is None and rows and rows[-1]["organisms"] == 0:
+        return rows[-1]["tick"]
+    return extinct_tick
+
+
+def read_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def run_ensemble(grid, seeds, ticks, out, engine="3d", workers=None, catalog=None, series_every=10,
+                 catalog_batch=100):
+    # Every combination of grid values is run once per seed, each in its own
+    # process. Rows are appended to `out` as runs finish, and runs already in
+    # `out` are skipped, so an interrupted sweep resumes where it stopped.
+    # With a catalog (a catalog.Catalog) the runs and their time series go
+    # there too, catalog_batch runs per transaction.
+    fields = ["run_id", "engine", "seed", "ticks", *sorted(grid), "population", "food", *COUNTERS, "extinct_tick",
+              "elapsed"]
+    tasks = [(engine, params, seed, ticks) for params in expand_grid(grid) for seed in seeds]
+
+    new_file = not os.path.exists(out) or os.path.getsize(out) == 0
+    if not new_file:
+        with open(out, newline="") as f:
+            header = next(csv.reader(f), [])
+        if header != fields:
+            raise ValueError(f"{out} holds results of a different sweep (columns {header})")
+    done = {row["run_id"] for row in read_results(out)}
+    pending = [task for task in tasks if run_id(*task) not in done]
+
+    finished = []
+    with open(out, "a", newline="") as f, ProcessPoolExecutor(workers) as pool:
+        writer = csv.DictWriter(f, fields, extrasaction="ignore")
+        if new_file:
+            writer.writeheader()
+        futures = [pool.submit(run_one, *task, series_every if catalog is not None else 0) for task in pending]
+        try:
+            for future in as_completed(futures):
+                row = future.result()
+                writer.writerow(row)
+                f.flush()
+                if catalog is not None:
+                    finished.append(row)
+                    if len(finished) >= catalog_batch:
+                        catalog.add(finished)
+                        finished = []
+        except KeyboardInterrupt:
+            pool.shutdown(cancel_futures=True)
+            raise
+        finally:
+            if finished:
+                catalog.add(finished)
+    return read_results(out)
+
+
+def parse_seeds(text):
+    # "1-5,8" -> [1, 2, 3, 4, 5, 8]
+    seeds = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        seeds.extend(range(int(first), int(last or first) + 1))
+    return seeds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="ensemble", description="Run many headless worlds across all cores")
+    parser.add_argument("--grid", default="{}",
+                        help='JSON object of GameWorld arguments to lists of values, '
+                             'e.g. \'{"food_regrowth": [[5, 20], [1, 5]], "trait_ranges.speed": [[2, 7], [5, 10]]}\'')
+    parser.add_argument("--seeds", default="1-8", help="seed list such as 1-10 or 1,5,9")
+    parser.add_argument("--ticks", type=int, default=500)
+    parser.add_argument("--engine", choices=["2d", "3d", "vectorized", "tiled"], default="3d")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--out", default="ensemble.csv")
+    parser.add_argument("--catalog", metavar="PATH", help="also store the runs in this SQLite run catalog")
+    parser.add_argument("--series-every", type=int, default=10, metavar="N",
+                        help="ticks between time series samples in the catalog")
+    args = parser.parse_args(argv)
+
+    catalog = None
+    if args.catalog:
+        from catalog import Catalog
+        catalog = Catalog(args.catalog)
+    try:
+        rows = run_ensemble(json.loads(args.grid), parse_seeds(args.seeds), args.ticks, args.out, args.engine,
+                            args.workers, catalog, args.series_every)
+    finally:
+        if catalog is not None:
+            catalog.close()
+    print(f"{len(rows)} runs in {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,35 @@
-import tkinter as tk
+import argparse
+import itertools
 import random
 import math
+import time
+
+import snapshot
+from profiling import Profiler
+from replay import Recorder
+from renderer import Renderer
+from scheduler import Scheduler
+from spatial import SpatialHash
+from telemetry import Telemetry
+
+# Attributes saved in snapshots, with their array type codes
+ORGANISM_FIELDS = {"x": "q", "y": "q", "energy": "d", "energy_idle_spending": "q", "energy_speed_spending": "q",
+                   "radius_of_sight": "q", "speed": "q", "random_move_chance": "d"}
+FOOD_FIELDS = {"x": "q", "y": "q"}
 
 class Organism:
     def __init__(self, game_world, x, y):
         self.game_world = game_world
-        self.canvas = game_world.canvas
         self.x = x
         self.y = y
         self.energy = 1000
-        self.energy_idle_spending = random.randint(1, 2)
-        self.energy_speed_spending = random.randint(5, 10)
+        self.energy_idle_spending = game_world.rng.randint(1, 2)
+        self.energy_speed_spending = game_world.rng.randint(5, 10)
         self.radius_of_sight = 50
         self.speed = 5
-        self.random_move_chance = random.random()
-        self.shape = self.canvas.create_rectangle(x - 5, y - 5, x + 5, y + 5, fill="blue")
+        self.random_move_chance = game_world.rng.random()
 
-    def move_towards_food(self):
-        nearest_food = min(self.game_world.food, key=lambda f: distance(self.x, self.y, f.x, f.y))
+    def move_towards_food(self, nearest_food):
         angle = math.atan2(nearest_food.y - self.y, nearest_food.x - self.x)
         new_x = int(self.x + self.speed * math.cos(angle))
         new_y = int(self.y + self.speed * math.sin(angle))
@@ -26,13 +38,13 @@ class Organism:
         new_x = max(0, min(new_x, self.game_world.width - 1))
         new_y = max(0, min(new_y, self.game_world.height - 1))
 
-        self.canvas.coords(self.shape, new_x - 5, new_y - 5, new_x + 5, new_y + 5)
         self.x = new_x
         self.y = new_y
+        self.game_world.move_entity(self)
         self.energy -= self.speed * self.energy_speed_spending
 
     def move_randomly(self):
-        angle = random.uniform(0, 2 * math.pi)
+        angle = self.game_world.rng.uniform(0, 2 * math.pi)
         new_x = int(self.x + self.speed * math.cos(angle))
         new_y = int(self.y + self.speed * math.sin(angle))
         
@@ -40,23 +52,17 @@ class Organism:
         new_x = max(0, min(new_x, self.game_world.width - 1))
         new_y = max(0, min(new_y, self.game_world.height - 1))
 
-        self.canvas.coords(self.shape, new_x - 5, new_y - 5, new_x + 5, new_y + 5)
         self.x = new_x
         self.y = new_y
+        self.game_world.move_entity(self)
         self.energy -= self.speed * self.energy_speed_spending / 2
 
     def decide_move(self):
-        food_in_sight = False
-
-        for food in self.game_world.food:
-            distance_to_food = distance(self.x, self.y, food.x, food.y)
-            if distance_to_food <= self.radius_of_sight:
-                food_in_sight = True
-                break
+        nearest_food = self.game_world.food_index.nearest((self.x, self.y), self.radius_of_sight)
 
-        if food_in_sight:
-            self.move_towards_food()
-        elif random.random() < self.random_move_chance:
+        if nearest_food is not None:
+            self.move_towards_food(nearest_food)
+        elif self.game_world.rng.random() < self.random_move_chance:
             self.move_randomly()
         else:
             self.energy -= self.speed * 2
@@ -65,100 +71,375 @@ class Organism:
         return self.energy <= 0
 
 class Food:
-    def __init__(self, canvas, x, y):
-        self.canvas = canvas
+    def __init__(self, x, y):
         self.x = x
         self.y = y
-        self.shape = canvas.create_oval(x - 5, y - 5, x + 5, y + 5, fill="green")
 
 def distance(x1, y1, x2, y2):
     return math.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
 
 class GameWorld:
-    def __init__(self, root, width=400, height=400):
-        self.root = root
-        self.canvas = tk.Canvas(root, width=400, height=400)
-        self.canvas.pack()
+    def __init__(self, width=400, height=400, cell_size=1, query_cell_size=32, initial_organisms=20, seed=None,
+                 timestep=0.1, food_interval=0.1, renderer=None, telemetry=None, populate=True):
+        self.renderer = renderer if renderer is not None else Renderer()
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
         self.width = width
         self.height = height
-        self.world_grid = [[[] for j in range(width)] for i in range(height)]
+        self.cell_size = cell_size
+        self.query_cell_size = query_cell_size
+        self.initial_organisms = initial_organisms
+        self.seed = seed
+        # Every random draw of this world comes from here, so a seed reproduces a run
+        self.rng = random.Random(seed)
+        self.ticks = 0
+        self.grid = SpatialHash(cell_size)
+        # Coarse index for what organisms can see; food never moves, so it is only touched on spawn and eat
+        self.food_index = SpatialHash(query_cell_size)
         self.organisms = []
-        self.food = []
+        # Insertion-ordered dict used as a set, so eaten food is dropped in O(1)
+        self.food = {}
+        # Cells something moved or spawned into since the last check_collision
+        self.entered_cells = set()
+        self.item_count = 0
+        self.timestep = timestep
+        self.food_interval = food_interval
+        # Food spawning and the organisms' update are jobs on one fixed-timestep clock
+        self.scheduler = Scheduler(timestep)
+        self.scheduler.every(food_interval, self.spawn_food_periodically)
+        self.scheduler.every(timestep, self.update)
 
-        for _ in range(20):
-            x = random.randint(0, width - 1)
-            y = random.randint(0, height - 1)
+        if populate:
+            self.populate()
+
+    def populate(self):
+        for _ in range(self.initial_organisms):
+            x = self.rng.randint(0, self.width - 1)
+            y = self.rng.randint(0, self.height - 1)
             organism = Organism(self, x, y)
-            self.world_grid[x][y].append(organism)
+            self.entered_cells.add(self.grid.insert(organism, x, y))
             self.organisms.append(organism)
+            self.renderer.add_organism(organism)
 
-        food_item = self.spawn_food()
-        self.world_grid[food_item[1]][food_item[2]].append(food_item[0])
-        self.check_collision()
         self.spawn_food_periodically()
-        self.update()
+
+    def move_entity(self, entity):
+        previous = self.grid.cell_of_entity.get(entity)
+        cell = self.grid.move(entity, entity.x, entity.y)
+        if cell != previous:
+            self.entered_cells.add(cell)
+        self.renderer.move(entity)
+
     def spawn_food_periodically(self):
         food_item = self.spawn_food()
-        self.world_grid[food_item[1]][food_item[2]].append(food_item[0])
+        self.entered_cells.add(self.grid.insert(food_item[0], food_item[1], food_item[2]))
         self.check_collision()
-        self.root.after(100, self.spawn_food_periodically)
+
     def check_collision(self):
-        item_count = 0
-        for i in self.world_grid:
-            for j in i:
-                element = j
-                if len(j) > 0: item_count += 1
-                if len(j) > 1:
-                    is_collision_with_food = False
-                    is_first_organism = False
-                    _first_organism = None
-                    _food_item =None
-                    for item in j:
-                        if type(item) == Food:
-                            is_collision_with_food = True
-                            _food_item = item
-                        else:
-                            if not is_first_organism:
-                                is_first_organism = True
-                                _first_organism = item
-                    
-                    print(f"COLLISION {len(j)}")
-                    if is_collision_with_food and is_first_organism:
-                        print(f"NUMNUMNUM {_first_organism.energy} {_food_item.shape}")
-                        _first_organism.energy += 100
-                        self.canvas.delete(_food_item.shape)
-                        self.food.remove(_food_item)
-
-        print(f"item_count {item_count}")
+        self.item_count = len(self.grid.cells)
+        # A collision can only be new in a cell something entered since the last
+        # check, or in one where an organism still shares a cell with food
+        eaten = {}
+        uneaten = set()
+        for cell in self.entered_cells:
+            j = self.grid.cells.get(cell, ())
+            if len(j) > 1:
+                is_collision_with_food = False
+                is_first_organism = False
+                _first_organism = None
+                _food_item =None
+                food_count = 0
+                for item in j:
+                    if type(item) == Food:
+                        is_collision_with_food = True
+                        _food_item = item
+                        food_count += 1
+                    else:
+                        if not is_first_organism:
+                            is_first_organism = True
+                            _first_organism = item
+
+                self.telemetry.event(self.ticks, "collision", detail=len(j))
+                if is_collision_with_food and is_first_organism:
+                    eaten[_food_item] = _first_organism
+                    if food_count > 1:
+                        uneaten.add(cell)
+        self.entered_cells = uneaten
+
+        # Apply all eat events of this check in one batch
+        for _food_item, _first_organism in eaten.items():
+            self.telemetry.event(self.ticks, "eat", color="blue", detail=_first_organism.energy)
+            _first_organism.energy += 100
+            self.renderer.remove(_food_item)
+            self.grid.remove(_food_item)
+            self.food_index.remove(_food_item)
+            del self.food[_food_item]
+
+    def add_food(self, x, y):
+        # Food put down from outside the simulation (control.py); eaten at the next collision check
+        food = Food(x, y)
+        self.food[food] = None
+        self.food_index.insert(food, x, y)
+        self.renderer.add_food(food)
+        self.entered_cells.add(self.grid.insert(food, x, y))
 
     def spawn_food(self):
         for _ in range(10):
-            x = random.randint(0, self.width - 1)
-            y = random.randint(0, self.height - 1)
-            food = Food(self.canvas, x, y)
-            self.food.append(food)
+            x = self.rng.randint(0, self.width - 1)
+            y = self.rng.randint(0, self.height - 1)
+            food = Food(x, y)
+            self.food[food] = None
+            self.food_index.insert(food, x, y)
+            self.renderer.add_food(food)
             return [food, x, y]
 
     def update(self):
-        self.world_grid = [[[] for j in range(self.width)] for i in range(self.height)]
-        
-        for _food in self.food:
-            self.world_grid[_food.x][_food.y].append( _food)
-        for organism in self.organisms:
+        for organism in list(self.organisms):
             if organism.is_dead():
-                self.canvas.delete(organism.shape)
+                self.telemetry.event(self.ticks, "death", color="blue", detail="starvation")
+                self.renderer.remove(organism)
+                self.grid.remove(organism)
                 self.organisms.remove(organism)
             else:
-                self.world_grid[organism.x][organism.y].append(organism)
+                # Moves keep organisms inside the world and update the grid themselves
                 organism.decide_move()
-                
-                # Ensure organisms do not move beyond canvas boundaries
-                organism.x = max(0, min(organism.x, self.width - 1))
-                organism.y = max(0, min(organism.y, self.height - 1))
-                
+
         self.check_collision()
-        self.root.after(100, self.update)
+        self.telemetry.tick(self.ticks, organisms=len(self.organisms), food=len(self.food),
+                            item_count=self.item_count)
+        self.ticks += 1
+
+    def tick(self):
+        self.scheduler.step()
+
+    def save_snapshot(self, path):
+        numbering = {entity: i for i, entity in enumerate(itertools.chain(self.organisms, self.food))}
+        columns = snapshot.entity_columns("organism.", self.organisms, ORGANISM_FIELDS)
+        columns.update(snapshot.entity_columns("food.", self.food, FOOD_FIELDS))
+        columns["grid_order"] = ("q", snapshot.index_order(self.grid, numbering))
+        columns["food_index_order"] = ("q", snapshot.index_order(self.food_index, numbering))
+        meta = {
+            "config": {"width": self.width, "height": self.height, "cell_size": self.cell_size,
+                       "query_cell_size": self.query_cell_size, "initial_organisms": self.initial_organisms,
+                       "seed": self.seed, "timestep": self.timestep, "food_interval": self.food_interval},
+            "engine": "2d",
+            "ticks": self.ticks,
+            "organisms": len(self.organisms),
+            "food": len(self.food),
+            "random": self.rng.getstate(),
+        }
+        snapshot.dump(path, meta, columns)
+
+    @classmethod
+    def load_snapshot(cls, path, renderer=None, telemetry=None):
+        meta, columns = snapshot.load(path, "2d")
+        world = cls(renderer=renderer, telemetry=telemetry, populate=False, **meta["config"])
+        world.ticks = world.scheduler.steps = meta["ticks"]
+        snapshot.set_random_state(world.rng, meta["random"])
+
+        world.organisms = snapshot.restore_entities(Organism, "organism.", columns, ORGANISM_FIELDS,
+                                                    meta["organisms"], game_world=world)
+        food = snapshot.restore_entities(Food, "food.", columns, FOOD_FIELDS, meta["food"])
+        world.food = dict.fromkeys(food)
+        entities = world.organisms + food
+        for i in columns["grid_order"]:
+            world.grid.insert(entities[i], entities[i].x, entities[i].y)
+        for i in columns["food_index_order"]:
+            world.food_index.insert(entities[i], entities[i].x, entities[i].y)
+
+        for organism in world.organisms:
+            world.renderer.add_organism(organism)
+        for food_item in food:
+            world.renderer.add_food(food_item)
+        return world
+
+
+# Phases of a tick for profiling.Profiler; each organism action is a phase of its own
+PROFILE_PHASES = {
+    "tick": [(GameWorld, "update")],
+    "decide": [(Organism, "decide_move")],
+    "perception": [(SpatialHash, "within")],
+    "seek food": [(Organism, "move_towards_food")],
+    "wander": [(Organism, "move_randomly")],
+    "grid": [(GameWorld, "move_entity"), (SpatialHash, "insert"), (SpatialHash, "move"), (SpatialHash, "remove")],
+    "eating": [(GameWorld, "check_collision")],
+    "food spawning": [(GameWorld, "spawn_food")],
+    "telemetry": [(Telemetry, "tick"), (Telemetry, "event")],
+}
+
+
+def run_gui(three_d=False, profile=False, speed=1.0, frame_rate=30, raster=False):
+    if three_d:
+        import genezis_3D
+        return genezis_3D.run_gui(profile, speed, frame_rate)
+
+    import tkinter as tk
+    from render_tk import TkRasterRenderer, TkRenderer
+
+    root = tk.Tk()
+    canvas = tk.Canvas(root, width=400, height=400)
+    canvas.pack()
+    profiler = Profiler(PROFILE_PHASES).enable() if profile else None
+    renderer = (TkRasterRenderer if raster else TkRenderer)(canvas, profiler)
+    game_world = GameWorld(renderer=renderer)
+    scheduler = game_world.scheduler
+    scheduler.speed = speed
+    scheduler.frame_rate = frame_rate
+
+    def frame():
+        if scheduler.advance():
+            renderer.draw(game_world)
+        root.after(max(1, int(1000 * scheduler.frame_delay())), frame)
+
+    frame()
+    root.mainloop()
+
+
+def run_headless(ticks, seed=None, three_d=False, vectorized=False, organisms=20, size=60, restore=None,
+                 checkpoint=None, checkpoint_every=0, telemetry=None, profile=False, profile_ticks=None,
+                 profile_out="genezis.prof", tiles=None, record=None, keyframe_every=100, catalog=None,
+                 series_every=10):
+    load_options = {}
+    if tiles:
+        from tiles import PROFILE_PHASES as phases, TiledWorld as world_class
+        config = dict(width=size, height=size, depth=size, cell_size=10, initial_organisms=organisms, tiles=tiles)
+        load_options = dict(tiles=tiles)
+        engine = "tiled"
+    elif vectorized:
+        from population import PROFILE_PHASES as phases, VectorGameWorld as world_class
+        config = dict(width=size, height=size, depth=size, cell_size=10, initial_organisms=organisms)
+        engine = "vectorized"
+    elif three_d:
+        from genezis_3D import PROFILE_PHASES as phases, GameWorld as world_class
+        config = dict(width=60, height=60, depth=60, cell_size=10)
+        engine = "3d"
+    else:
+        world_class = GameWorld
+        phases = PROFILE_PHASES
+        config = {}
+        engine = "2d"
+
+    # Enabled before the world exists, so the tick method bound below is the timed one
+    profiler = Profiler(phases)
+    if profile_ticks:
+        profiler.profile_ticks(*profile_ticks, profile_out)
+    elif profile:
+        profiler.enable()
+
+    if restore:
+        world = world_class.load_snapshot(restore, telemetry=telemetry, **load_options)
+    else:
+        world = world_class(seed=seed, telemetry=telemetry, **config)
+    recorder = Recorder(record, keyframe_every).attach(world) if record else None
+    step = world.tick
+
+    # Telemetry counters of every series_every-th tick, and the tick the
+    # population died out, for the run catalog
+    if catalog:
+        from ensemble import extinction
+    series = []
+    extinct_tick = None
+    started = time.perf_counter()
+    try:
+        for _ in range(ticks):
+            step()
+            if checkpoint and checkpoint_every and world.ticks % checkpoint_every == 0:
+                world.save_snapshot(checkpoint)
+            if catalog:
+                rows = world.telemetry.tick_rows
+                if rows and rows[-1]["tick"] % series_every == 0:
+                    series.append(rows[-1])
+                extinct_tick = extinction(rows, extinct_tick)
+        elapsed = time.perf_counter() - started
+        if checkpoint:
+            world.save_snapshot(checkpoint)
+        world.telemetry.flush()
+        if recorder:
+            recorder.close()
+        profiler.disable()
+        if catalog:
+            from catalog import add_world
+            params = dict(config, restore=restore) if restore else config
+            add_world(catalog, world, engine, params, seed, ticks, round(elapsed, 3), series, extinct_tick)
+
+        print(f"ticks {ticks}, organisms {len(world.organisms)}, food {len(world.food)}, "
+              f"{elapsed:.2f}s ({ticks / max(elapsed, 1e-9):.0f} ticks/s)")
+        if profile_ticks and world.ticks <= profile_ticks[0]:
+            print(f"the run ended at tick {world.ticks}, before tick {profile_ticks[0]}: no profile written")
+        elif profile_ticks and world.ticks < profile_ticks[1]:
+            print(f"the run ended at tick {world.ticks}, so {profile_out} only covers ticks "
+                  f"{profile_ticks[0]} to {world.ticks - 1}")
+    finally:
+        if tiles:
+            # Stops the worker processes
+            world.close()
+    if profile:
+        print(profiler.report())
+    return world
+
+
+def tick_range(text):
+    first, _, last = text.partition(":")
+    return int(first), int(last)
+
+
+def tile_grid(text):
+    # "4" -> (4, 1, 1), "2,2,1" -> (2, 2, 1)
+    counts = [int(value) for value in text.split(",")]
+    return tuple(counts + [1] * (3 - len(counts)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="genezis")
+    commands = parser.add_subparsers(dest="command")
+
+    gui = commands.add_parser("gui", help="open the tkinter (or vpython with --3d) window")
+    gui.add_argument("--3d", dest="three_d", action="store_true")
+    gui.add_argument("--profile", action="store_true", help="show time per phase on screen")
+    gui.add_argument("--speed", type=float, default=1.0,
+                     help="simulated seconds per second; 0 runs as many steps as fit between frames")
+    gui.add_argument("--fps", type=int, default=30, help="frames drawn per second")
+    gui.add_argument("--raster", action="store_true",
+                     help="draw each frame as one image instead of a canvas item per entity")
+
+    run = commands.add_parser("run", help="simulate without a display, as fast as possible")
+    run.add_argument("--ticks", type=int, default=1000)
+    run.add_argument("--seed", type=int)
+    run.add_argument("--3d", dest="three_d", action="store_true")
+    run.add_argument("--vectorized", action="store_true",
+                     help="3D world on the NumPy population store (population.VectorGameWorld)")
+    run.add_argument("--organisms", type=int, default=20, help="initial population (--vectorized)")
+    run.add_argument("--size", type=int, default=60, help="edge of the world cube (--vectorized)")
+    run.add_argument("--tiles", type=tile_grid, metavar="X[,Y,Z]",
+                     help="split the --vectorized world into tiles run by this many worker processes per axis")
+    run.add_argument("--restore", metavar="PATH", help="continue from a snapshot of the same kind of world")
+    run.add_argument("--checkpoint", metavar="PATH", help="save a snapshot here at the end of the run")
+    run.add_argument("--checkpoint-every", type=int, default=0, metavar="N", help="and every N ticks")
+    run.add_argument("--verbosity", type=int, choices=[0, 1, 2], default=0,
+                     help="0: quiet, 1: print counters every tick, 2: also print every event")
+    run.add_argument("--telemetry", metavar="PREFIX", help="write PREFIX.ticks.csv and PREFIX.events.csv")
+    run.add_argument("--profile", action="store_true", help="print time and calls per phase at the end")
+    run.add_argument("--profile-ticks", type=tick_range, metavar="FIRST:LAST",
+                     help="write a cProfile dump of these ticks to --profile-out")
+    run.add_argument("--profile-out", default="genezis.prof", metavar="PATH")
+    run.add_argument("--record", metavar="PATH", help="write a replay log for python -m replay")
+    run.add_argument("--keyframe-every", type=int, default=100, metavar="N",
+                     help="ticks between full states in the replay log")
+    run.add_argument("--catalog", metavar="PATH", help="store the run in this SQLite run catalog")
+    run.add_argument("--series-every", type=int, default=10, metavar="N",
+                     help="ticks between time series samples in the catalog")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run_headless(args.ticks, args.seed, args.three_d, args.vectorized, args.organisms, args.size,
+                     args.restore, args.checkpoint, args.checkpoint_every,
+                     Telemetry(args.verbosity, path=args.telemetry), args.profile, args.profile_ticks,
+                     args.profile_out, args.tiles, args.record, args.keyframe_every, args.catalog,
+                     args.series_every)
+    elif args.command == "gui":
+        run_gui(args.three_d, args.profile, args.speed or None, args.fps, args.raster)
+    else:
+        run_gui()
+
 
-root = tk.Tk()
-game_world = GameWorld(root)
-root.mainloop()
+if __name__ == "__main__":
+    main()
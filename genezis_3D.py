@@ -1,10 +1,100 @@
-from vpython import *
-from vpython import color
 import random
 import math
 import numpy as np
 
+import snapshot
+from profiling import Profiler
+from renderer import Renderer
+from resources import FoodField
+from scheduler import Scheduler
+from spatial import SpatialHash, SphereWatch
+from telemetry import Telemetry
+
+COLORS = [(0.6, 0.4, 0.2), (0, 0, 1), (0.6, 0.2, 0.6), (0, 1, 1), (1, 0.8, 0), (1, 0, 1)]
+
+# Ranges new organisms draw their traits from, in drawing order. Integer ranges
+# are inclusive like random.randint; None means random.random().
+TRAIT_RANGES = {
+    "basic_energy_amount": (100, 200),
+    "speed": (2, 7),
+    "radius_of_sight": (10, 70),
+    "energy_idle_spending": (1, 2),
+    "energy_run_spending": (1, 10),
+    "energy_find_walk_spending": (2, 4),
+    "random_move_chance": None,
+    "attack_chance": None,
+    "attack_radius": (1, 5),
+    "attack_damage": (1, 30),
+}
+
+# Attributes saved in snapshots, with their array type codes; colour is saved as its index in COLORS
+ORGANISM_FIELDS = {"x": "d", "y": "d", "z": "d", "energy": "d", "national_id": "q"}
+GENOME_FIELDS = {name: "d" if bounds is None else "q" for name, bounds in TRAIT_RANGES.items()}
+
+
+class Genome:
+    # Heritable traits of an organism, one slot each. A child shares its
+    # parent's genome unless it mutates, so a birth copies one reference.
+    __slots__ = (*TRAIT_RANGES, "color")
+
+    def __init__(self, color, **traits):
+        self.color = color
+        for name, value in traits.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def random(cls, rng, trait_ranges):
+        traits = {name: rng.random() if bounds is None else rng.randint(*bounds) for name, bounds in trait_ranges.items()}
+        return cls(rng.choice(COLORS), **traits)
+
+    def traits(self):
+        return {name: getattr(self, name) for name in TRAIT_RANGES}
+
+
+class Mutation:
+    # Applied to every child when a world has one. Each trait changes with
+    # probability `rate` by a normal step of `scale` times the width of its
+    # range (chances by `scale` itself); integer traits stay at least 1 and
+    # chances within 0..1. With probability `color_rate` the child also gets
+    # a random colour, which makes it an enemy of its relatives.
+
+    def __init__(self, rate=0.1, scale=0.1, color_rate=0.0):
+        self.rate = rate
+        self.scale = scale
+        self.color_rate = color_rate
+
+    def step(self, bounds):
+        return self.scale * (1 if bounds is None else bounds[1] - bounds[0])
+
+    def mutate(self, genome, rng, trait_ranges):
+        traits = None
+        for name, bounds in trait_ranges.items():
+            if rng.random() < self.rate:
+                traits = traits or genome.traits()
+                value = traits[name] + rng.gauss(0, self.step(bounds))
+                traits[name] = min(1.0, max(0.0, value)) if bounds is None else max(1, round(value))
+        color = genome.color
+        if self.color_rate and rng.random() < self.color_rate:
+            color = rng.choice(COLORS)
+        if traits is None and color == genome.color:
+            return genome
+        return Genome(color, **(traits or genome.traits()))
+
+    def mutate_columns(self, columns, rng, trait_ranges):
+        # The same for a batch of children held as arrays, e.g. by VectorGameWorld
+        count = len(columns["color"])
+        for name, bounds in trait_ranges.items():
+            mutated = rng.random(count) < self.rate
+            value = columns[name] + mutated * rng.normal(0, self.step(bounds), count)
+            columns[name] = np.clip(value, 0, 1) if bounds is None else np.maximum(1, np.round(value))
+        if self.color_rate:
+            recolored = rng.random(count) < self.color_rate
+            columns["color"] = np.where(recolored, rng.integers(0, len(COLORS), count), columns["color"])
+
+
 class Organism:
+    __slots__ = ("game_world", "x", "y", "z", "energy", "national_id", "genome", "sleep")
+
     def __init__(self, game_world, x, y, z, national_id, parent=None):
         self.game_world = game_world
         self.x, self.y, self.z = x, y, z
@@ -12,126 +102,76 @@ class Organism:
         if parent:
             # Inherit characteristics from the parent
             self.national_id = parent.national_id
-            self.basic_energy_amount = parent.basic_energy_amount
-            self.speed = parent.speed
-            self.radius_of_sight = parent.radius_of_sight
-            self.energy_idle_spending = parent.energy_idle_spending
-            self.energy_run_spending = parent.energy_run_spending
-            self.energy_find_walk_spending = parent.energy_find_walk_spending
-            self.random_move_chance = parent.random_move_chance
-            self.attack_chance = parent.attack_chance
-            self.attack_radius = parent.attack_radius
-            self.attack_damage = parent.attack_damage
-            self.color = parent.color
+            self.genome = parent.genome
+            if game_world.mutation is not None:
+                self.genome = game_world.mutation.mutate(parent.genome, game_world.rng, game_world.trait_ranges)
         else:
             # Randomly set characteristics for a new organism
             self.national_id = national_id
-            self.basic_energy_amount = random.randint(100, 200)
-            self.speed = random.randint(2, 7)
-            self.radius_of_sight = random.randint(10, 70)
-            self.energy_idle_spending = random.randint(1, 2)
-            self.energy_run_spending = random.randint(1, 10)
-            self.energy_find_walk_spending = random.randint(2, 4)
-            self.random_move_chance = random.random()
-            self.attack_chance = random.random()
-            self.attack_radius = random.randint(1, 5)
-            self.attack_damage = random.randint(1,30)
-            self.color = random.choice([vector(0.6, 0.4, 0.2), vector(0, 0, 1), vector(0.6, 0.2, 0.6),
-                            vector(0, 1, 1), vector(1, 0.8, 0), vector(1, 0, 1)])
-            if hasattr(color, 'rgb_to_vector'):
-                self.shape = sphere(pos=vector(x, y, z), radius=5, color=color.rgb_to_vector(self.color))
-            else:
-                self.shape = sphere(pos=vector(x, y, z), radius=5, color=self.color)
-
-        self.energy = self.basic_energy_amount
-        self.create_shape()
-        #self.shape = sphere(pos=vector(x, y, z), radius=5, color=self.color)
-
-
-    def move_towards_food(self):
-        nearest_food = min(self.game_world.food, key=lambda f: np.linalg.norm(np.array([self.x, self.y, self.z]) - f.position))
-        angle = math.atan2(nearest_food.position[1] - self.y, nearest_food.position[0] - self.x)
-        new_x = self.x + self.speed * math.cos(angle)
-        new_y = self.y + self.speed * math.sin(angle)
-        new_z = self.z + self.speed * math.cos(angle)
-
-        new_grid_x = round(new_x / self.game_world.cell_size)
-        new_grid_y = round(new_y / self.game_world.cell_size)
-        new_grid_z = round(new_z / self.game_world.cell_size)
+            self.genome = Genome.random(game_world.rng, game_world.trait_ranges)
 
-        if 0 <= new_x < self.game_world.width and 0 <= new_y < self.game_world.height and 0 <= new_z < self.game_world.depth:
-            if not self.game_world.is_occupied(new_grid_x, new_grid_y, new_grid_z):
-                self.update_position(new_x, new_y, new_z)
+        self.energy = self.genome.basic_energy_amount
+        # (centre, margin squared, nearby enemies) while asleep,
+        # see GameWorld.enemy_in_sight
+        self.sleep = None
 
-                if np.linalg.norm(np.array([new_x, new_y, new_z]) - nearest_food.position) < self.game_world.cell_size:
-                    self.eat_food(nearest_food)
+    @property
+    def color(self):
+        return self.genome.color
 
-        # Calculate the grid indices for the new position
-        new_grid_x = round(new_x / self.game_world.cell_size)
-        new_grid_y = round(new_y / self.game_world.cell_size)
-        new_grid_z = round(new_z / self.game_world.cell_size)
 
-        # Check if the new position is within the canvas boundaries
+    def move_towards_food(self, food_cell):
+        food_position = self.game_world.food.centre(food_cell)
+        angle = math.atan2(food_position[1] - self.y, food_position[0] - self.x)
+        new_x = self.x + self.genome.speed * math.cos(angle)
+        new_y = self.y + self.genome.speed * math.sin(angle)
+        new_z = self.z + self.genome.speed * math.cos(angle)
+
         if 0 <= new_x < self.game_world.width and 0 <= new_y < self.game_world.height and 0 <= new_z < self.game_world.depth:
-            # Check if the new position is occupied by another organism or food
-            if not self.game_world.is_occupied(new_grid_x, new_grid_y, new_grid_z):
+            if not self.game_world.is_occupied(new_x, new_y, new_z, ignore=self):
                 self.update_position(new_x, new_y, new_z)
 
                 # Check if the organism is adjacent to the food
-                if np.linalg.norm(np.array([new_x, new_y, new_z]) - nearest_food.position) < self.game_world.cell_size:
-                    self.eat_food(nearest_food)
-                    
-    def eat_food(self, food):
-        self.energy += food.food_value
-        food.shape.visible = False
+                if distance(new_x, new_y, new_z, *food_position) < self.game_world.cell_size:
+                    self.eat_food(food_cell)
 
-        if food in self.game_world.food:
-            self.game_world.food.remove(food)
+    def eat_food(self, food_cell):
+        self.energy += self.game_world.food.take(food_cell)
 
         # Reproduce if energy is more than twice the basic value
-        if self.energy > 2 * self.basic_energy_amount:
+        if self.energy > 2 * self.genome.basic_energy_amount:
             self.reproduce()
 
 
     def move_randomly(self):
-        angle = random.uniform(0, 2 * math.pi)
-        new_x = self.x + self.speed * math.cos(angle)
-        new_y = self.y + self.speed * math.sin(angle)
-        new_z = self.z + self.speed * math.sin(angle)
+        angle = self.game_world.rng.uniform(0, 2 * math.pi)
+        new_x = self.x + self.genome.speed * math.cos(angle)
+        new_y = self.y + self.genome.speed * math.sin(angle)
+        new_z = self.z + self.genome.speed * math.sin(angle)
         self.update_position(new_x, new_y, new_z)
 
-        angle = random.uniform(0, 2 * math.pi)
-        new_x = round(self.x + self.speed * math.cos(angle))
-        new_y = round(self.y + self.speed * math.sin(angle))
-        new_z = round(self.z + self.speed * math.sin(angle))
+        angle = self.game_world.rng.uniform(0, 2 * math.pi)
+        new_x = round(self.x + self.genome.speed * math.cos(angle))
+        new_y = round(self.y + self.genome.speed * math.sin(angle))
+        new_z = round(self.z + self.genome.speed * math.sin(angle))
         self.update_position(new_x, new_y, new_z)
         
-    def create_shape(self):
-        if hasattr(color, 'rgb_to_vector'):
-            self.shape = sphere(pos=vector(self.x, self.y, self.z), radius=5, color=color.rgb_to_vector(self.color))
-        else:
-            self.shape = sphere(pos=vector(self.x, self.y, self.z), radius=5, color=self.color)
-
     def reproduce(self):
         # Create a new organism near the current one with the same characteristics
-        new_x = self.x + random.randint(-5, 5)
-        new_y = self.y + random.randint(-5, 5)
-        new_z = self.z + random.randint(-5, 5)
+        new_x = self.x + self.game_world.rng.randint(-5, 5)
+        new_y = self.y + self.game_world.rng.randint(-5, 5)
+        new_z = self.z + self.game_world.rng.randint(-5, 5)
 
         # Ensure the new position is within the canvas boundaries
         new_x = max(0, min(new_x, self.game_world.width - 1))
         new_y = max(0, min(new_y, self.game_world.height - 1))
         new_z = max(0, min(new_z, self.game_world.depth - 1))
 
-        # Check if the new position is occupied by another organism or food
-        if not self.game_world.is_occupied(round(new_x / self.game_world.cell_size),
-                                        round(new_y / self.game_world.cell_size),
-                                        round(new_z / self.game_world.cell_size)):
+        # Check if the new position is occupied by another organism
+        if not self.game_world.is_occupied(new_x, new_y, new_z):
             new_organism = Organism(self.game_world, int(new_x), int(new_y), int(new_z), self.national_id, parent=self)
-            self.game_world.world_grid[round(new_x / self.game_world.cell_size)][round(new_y / self.game_world.cell_size)][round(new_z / self.game_world.cell_size)].append(
-                new_organism)
-            self.game_world.organisms.append(new_organism)
-            #print(f"Reproducing! Parent energy: {self.energy}, Child energy: {new_organism.energy}")
+            self.game_world.add_organism(new_organism)
+            self.game_world.telemetry.event(self.game_world.ticks, "birth", self.national_id, self.color)
 
 
     def update_position(self, new_x, new_y, new_z):
@@ -139,105 +179,81 @@ class Organism:
         new_y = max(0, min(new_y, self.game_world.height - 1))
         new_z = max(0, min(new_z, self.game_world.depth - 1))
 
-        new_grid_x = round(new_x / self.game_world.cell_size)
-        new_grid_y = round(new_y / self.game_world.cell_size)
-        new_grid_z = round(new_z / self.game_world.cell_size)
-
-        if not self.game_world.is_occupied(new_grid_x, new_grid_y, new_grid_z):
+        if not self.game_world.is_occupied(new_x, new_y, new_z, ignore=self):
             self.x, self.y, self.z = new_x, new_y, new_z
-            self.shape.pos = vector(new_x, new_y, new_z)
+            self.game_world.grid.move(self, new_x, new_y, new_z)
+            self.game_world.organism_index.move(self, new_x, new_y, new_z)
+            self.game_world.disturb(self)
+            self.game_world.renderer.move(self)
+
+    def is_enemy(self, organism):
+        return organism.national_id != self.national_id and organism.genome.color != self.genome.color
 
     def decide_move(self):
-        food_in_sight = False
-        organism_in_sight = False
-        nearest_food = None
-        nearest_organism = None
-
-        for food in self.game_world.food:
-            distance_to_food = distance(self.x, self.y, self.z, food.position[0], food.position[1], food.position[2])
-            if distance_to_food <= self.radius_of_sight:
-                food_in_sight = True
-                if nearest_food is None or distance_to_food < distance(self.x, self.y, self.z, nearest_food.position[0], nearest_food.position[1], nearest_food.position[2]):
-                    nearest_food = food
-
-        for organism in self.game_world.organisms:
-            if organism.national_id != self.national_id and organism.color != self.color:
-                distance_to_organism = distance(self.x, self.y, self.z, organism.x, organism.y, organism.z)
-                if distance_to_organism <= self.radius_of_sight:
-                    organism_in_sight = True
-                    if nearest_organism is None or distance_to_organism < distance(self.x, self.y, self.z, nearest_organism.x, nearest_organism.y, nearest_organism.z):
-                        nearest_organism = organism
+        genome = self.genome
+        if self.sleep is not None and self.game_world.still_asleep(self):
+            # No food can have come into sight since the organism last looked
+            food_in_sight = False
+        else:
+            nearest_food = self.game_world.food.nearest((self.x, self.y, self.z), genome.radius_of_sight)
+            food_in_sight = nearest_food is not None
+        # Enemies only matter to an organism with no food to go for
+        organism_in_sight = not food_in_sight and self.game_world.enemy_in_sight(self)
 
         if food_in_sight:
-            self.move_towards_food()
-            self.energy -= self.speed * self.energy_run_spending
-        elif organism_in_sight and random.random() < self.attack_chance:
-            self.attack_nearest_organism(nearest_organism)
-        elif random.random() < self.random_move_chance:
+            self.move_towards_food(nearest_food)
+            self.energy -= genome.speed * genome.energy_run_spending
+        elif organism_in_sight and self.game_world.rng.random() < genome.attack_chance:
+            # Resolved together with every other attack in GameWorld.resolve_combat
+            self.game_world.attackers.append(self)
+        elif self.game_world.rng.random() < genome.random_move_chance:
             self.move_randomly()
-            self.energy -= self.speed * self.energy_find_walk_spending
+            self.energy -= genome.speed * genome.energy_find_walk_spending
         else:
-            self.energy -= self.energy_idle_spending
-
-    def attack_nearest_organism(self, target_organism):
-        distance_to_target = distance(self.x, self.y, self.z, target_organism.x, target_organism.y, target_organism.z)
-        color_tuple = (target_organism.color.x, target_organism.color.y, target_organism.color.z)
-
-        if distance_to_target < self.attack_radius:
-            target_organism.energy -= self.attack_damage
-            if target_organism.is_dead():
-                self.game_world.dead_organisms_count += 1
-                self.game_world.dead_by_attack_count += 1
-
-                if color_tuple not in self.game_world.dead_colors_counter:
-                    self.game_world.dead_colors_counter[color_tuple] = 1
-                else:
-                    self.game_world.dead_colors_counter[color_tuple] += 1
-
-                target_organism.shape.visible = False
-                self.game_world.organisms.remove(target_organism)
-                self.game_world.mark_fight_location(target_organism.x, target_organism.y, target_organism.z)
-
-                print(f"attack_nearest_organism {self.color} ---->>>[DEAD] {target_organism.color}")
-            else:
-                self.energy -= target_organism.attack_damage
-                if self.is_dead():
-                    self.game_world.dead_organisms_count += 1
-                    self.game_world.dead_by_attack_count += 1
-
-                    if color_tuple not in self.game_world.dead_colors_counter:
-                        self.game_world.dead_colors_counter[color_tuple] = 1
-                    else:
-                        self.game_world.dead_colors_counter[color_tuple] += 1
-
-                    target_organism.shape.visible = False
-                    self.game_world.organisms.remove(self)
-                    self.game_world.mark_fight_location(self.x, self.y, self.z)
-                    print(f"attack_nearest_organism {self.color} [DEAD] ---->>> {target_organism.color}")
-                else:
-                    print(f"attack_nearest_organism {self.color} {self.energy}---->>> {target_organism.color} {target_organism.energy}")
+            self.energy -= genome.energy_idle_spending
+
     def is_dead(self):
         return self.energy <= 0
 
-class Food:
-    def __init__(self, game_world, x, y, z):
-        self.food_value = random.randint(50, 100)
-        self.position = np.array([x, y, z])
-        self.shape = sphere(pos=vector(x, y, z), radius=3, color=color.green)
-
-
 def distance(x1, y1, z1, x2, y2, z2):
     return math.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2 + (z1 - z2) ** 2)
 
 class GameWorld:
-    def __init__(self, width=400, height=400, depth=400, cell_size=10):
+    def __init__(self, width=400, height=400, depth=400, cell_size=10, query_cell_size=32, initial_organisms=20,
+                 food_capacity=100, food_regrowth=(5, 20), trait_ranges=None, seed=None, timestep=1 / 60,
+                 food_interval=1 / 60, mutation=None, sleep_margin=3, renderer=None, telemetry=None, populate=True):
+        self.renderer = renderer if renderer is not None else Renderer()
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.initial_organisms = initial_organisms
+        self.food_capacity = food_capacity
+        self.food_regrowth = food_regrowth
+        self.trait_ranges = dict(TRAIT_RANGES, **(trait_ranges or {}))
+        # None, a Mutation or its arguments as a dict (as stored in snapshots)
+        self.mutation = Mutation(**mutation) if isinstance(mutation, dict) else mutation
+        self.seed = seed
+        # Every random draw of this world comes from here, so a seed reproduces a run
+        self.rng = random.Random(seed)
+        self.ticks = 0
         self.width = width
         self.height = height
         self.depth = depth
-        self.world_grid = [[[[] for k in range(depth)] for j in range(width)] for i in range(height)]
+        self.query_cell_size = query_cell_size
+        # Occupancy: only organisms block movement
+        self.grid = SpatialHash(cell_size)
+        # Coarser index shared by every organism's perception, updated as they move
+        self.organism_index = SpatialHash(query_cell_size)
+        # Organisms that see no food stop looking for it and only follow the
+        # enemies near them (see enemy_in_sight) until they wander further
+        # than sleep_margin times their speed or food sprouts nearby;
+        # None makes every organism look around every tick
+        self.sleep_margin = sleep_margin
+        self.watch = SphereWatch(query_cell_size)
         self.organisms = []
-        self.food = []
+        # Organisms that chose to attack this tick, in the order they acted
+        self.attackers = []
         self.cell_size = cell_size
+        # Food per grid cell, bounded by food_capacity
+        self.food = self.new_food_field()
 
         self.dead_organisms_count = 0
         self.dead_by_attack_count = 0
@@ -254,25 +270,140 @@ class GameWorld:
             "magenta": 0
         }
 
-        for i in range(20):
-            x = random.randint(0, width - 1)
-            y = random.randint(0, height - 1)
-            z = random.randint(0, depth - 1)
+        self.timestep = timestep
+        self.food_interval = food_interval
+        # Food regrowth and the organisms' update are jobs on one fixed-timestep clock
+        self.scheduler = Scheduler(timestep)
+        self.scheduler.every(timestep, self.update)
+        self.scheduler.every(food_interval, self.grow_food)
+
+        if populate:
+            self.populate()
+
+    def populate(self):
+        for i in range(self.initial_organisms):
+            x = self.rng.randint(0, self.width - 1)
+            y = self.rng.randint(0, self.height - 1)
+            z = self.rng.randint(0, self.depth - 1)
             organism = Organism(self, x, y, z, i)
-            self.world_grid[x][y][z].append(organism)
-            self.organisms.append(organism)
-
-        self.spawn_food_periodically()
-        self.update()
-
-    def is_occupied(self, grid_x, grid_y, grid_z):
-        return len(self.world_grid[grid_x][grid_y][grid_z]) > 0
-
-    def spawn_food_periodically(self):
-        self.spawn_food()
-        while True:
-            #rate(1)
-            self.update()
+            self.add_organism(organism)
+
+    def new_food_field(self):
+        return FoodField(self.width, self.height, self.depth, self.cell_size, self.food_capacity, self.food_regrowth,
+                         rng=np.random.default_rng(self.rng.getrandbits(64)))
+
+    def is_occupied(self, x, y, z, ignore=None):
+        return self.grid.is_occupied(x, y, z, ignore=ignore)
+
+    def add_organism(self, organism):
+        self.organisms.append(organism)
+        self.grid.insert(organism, organism.x, organism.y, organism.z)
+        self.organism_index.insert(organism, organism.x, organism.y, organism.z)
+        self.disturb(organism)
+        self.renderer.add_organism(organism)
+
+    def enemy_in_sight(self, organism):
+        # Asked by an organism that sees no food. Unless there is food within
+        # its sight plus a margin of sleep_margin steps, it falls asleep: it
+        # stops looking for food and keeps the enemies within that reach as a
+        # list that disturb() adds every enemy moving or being born into it
+        # to. Only a list lookup is left until the organism leaves the margin
+        # or food sprouts within the reach (see grow_food).
+        genome = organism.genome
+        position = (organism.x, organism.y, organism.z)
+        if organism.sleep is None:
+            if self.sleep_margin is None:
+                return self.organism_index.nearest(position, genome.radius_of_sight,
+                                                   accept=organism.is_enemy) is not None
+            margin = self.sleep_margin * genome.speed
+            # One more unit keeps rounding at the edge of the reach on the safe side
+            reach = genome.radius_of_sight + margin + 1
+            if self.food.nearest(position, reach) is not None:
+                return self.organism_index.nearest(position, genome.radius_of_sight,
+                                                   accept=organism.is_enemy) is not None
+            enemies = {enemy for _, enemy in self.organism_index.within(position, reach, accept=organism.is_enemy)}
+            organism.sleep = (position, margin * margin, enemies)
+            self.watch.add(organism, position, reach)
+        enemies = organism.sleep[2]
+        sight2 = genome.radius_of_sight * genome.radius_of_sight
+        positions = self.organism_index.position_of_entity
+        return any(enemy in positions and sum((a - b) ** 2 for a, b in zip(positions[enemy], position)) <= sight2
+                   for enemy in enemies)
+
+    def add_food(self, cells):
+        # Food put down from outside the simulation (control.py) wakes the
+        # sleepers near it like regrown food
+        cells = np.asarray(cells, dtype=np.int64).reshape(-1, 3)
+        self.food.fill(cells)
+        self.wake_near(cells)
+
+    def still_asleep(self, organism):
+        centre, margin2, _ = organism.sleep
+        if sum((a - b) ** 2 for a, b in zip(centre, (organism.x, organism.y, organism.z))) <= margin2:
+            return True
+        self.wake(organism)
+        return False
+
+    def wake(self, organism):
+        if organism.sleep is not None:
+            organism.sleep = None
+            self.watch.remove(organism)
+
+    def disturb(self, organism):
+        # The organism moved or was born: sleepers it came close to have to
+        # keep an eye on it if it is their enemy
+        if self.watch.spheres:
+            for sleeper in self.watch.entered(organism.x, organism.y, organism.z):
+                if sleeper.is_enemy(organism):
+                    sleeper.sleep[2].add(organism)
+
+    def resolve_combat(self):
+        # Every attacker hits the nearest enemy within its attack_radius, all
+        # hits land at once, and every target still alive after them strikes
+        # back at each of its attackers. Pairs are taken in the order the
+        # attackers acted; a target is credited to its first attacker. The dead
+        # stay in the world until the cull at the end of update.
+        pairs = []
+        for attacker in self.attackers:
+            if attacker.is_dead():
+                continue
+            target = self.organism_index.nearest((attacker.x, attacker.y, attacker.z), attacker.genome.attack_radius,
+                                                 accept=lambda organism: attacker.is_enemy(organism)
+                                                 and not organism.is_dead())
+            if target is not None:
+                pairs.append((attacker, target))
+        self.attackers = []
+
+        for attacker, target in pairs:
+            target.energy -= attacker.genome.attack_damage
+        for attacker, target in pairs:
+            if not target.is_dead():
+                attacker.energy -= target.genome.attack_damage
+
+        killed = set()
+        for attacker, target in pairs:
+            for victim, killer in ((target, attacker), (attacker, target)):
+                if victim.is_dead() and victim not in killed:
+                    killed.add(victim)
+                    self.dead_organisms_count += 1
+                    self.dead_by_attack_count += 1
+                    self.dead_colors_counter[victim.color] = self.dead_colors_counter.get(victim.color, 0) + 1
+                    self.mark_fight_location(victim.x, victim.y, victim.z)
+                    self.record_kill(killer, victim)
+        return killed
+
+    def cull(self, killed=()):
+        # Removes every dead organism in one pass; the ones not in `killed` starved
+        dead = [organism for organism in self.organisms if organism.is_dead()]
+        for organism in dead:
+            if organism not in killed:
+                self.telemetry.event(self.ticks, "death", organism.national_id, organism.color, "starvation")
+            self.grid.remove(organism)
+            self.organism_index.remove(organism)
+            self.wake(organism)
+            self.renderer.remove(organism)
+        if dead:
+            self.organisms = [organism for organism in self.organisms if not organism.is_dead()]
 
     def keydown(self, evt):
         self.keyup[evt.key] = 1
@@ -289,83 +420,56 @@ class GameWorld:
     def mouseup(self, evt):
         pass
 
-    def spawn_food(self):
-        food_to_spawn = random.randint(5, 20)
-        for _ in range(food_to_spawn):
-            x = random.randint(0, self.width - 1)
-            y = random.randint(0, self.height - 1)
-            z = random.randint(0, self.depth - 1)
-            food = Food(self, x, y, z)
+    def grow_food(self):
+        self.wake_near(self.food.regrow())
 
-            food.position = np.array([x, y, z])
-
-            self.world_grid[x][y][z].append(food)
-            self.food.append(food)
-        self.update()
+    def wake_near(self, cells):
+        # Sleepers whose reach takes in a cell that got food look again
+        if self.watch.spheres:
+            for cell in cells.tolist():
+                for sleeper in self.watch.entered(*self.food.centre(cell)):
+                    self.wake(sleeper)
 
     def update(self):
-        self.world_grid = [[[[] for k in range(self.depth)] for j in range(self.width)] for i in range(self.height)]
-
         # Process organisms
-        living_organisms = []
-        for organism in self.organisms:
+        for organism in list(self.organisms):
+            # Organisms that starved earlier in this tick stay put until the cull
             if not organism.is_dead():
-                self.world_grid[int(organism.x)][int(organism.y)][int(organism.z)].append(organism)
+                # update_position keeps organisms inside the world and moves them in the grid
                 organism.decide_move()
-
-                # Ensure organisms do not move beyond canvas boundaries
-                organism.x = max(0, min(organism.x, self.width - 1))
-                organism.y = max(0, min(organism.y, self.height - 1))
-                organism.z = max(0, min(organism.z, self.depth - 1))
-                living_organisms.append(organism)
-            else:
-                organism.shape.visible = False
-        # Check collision after processing all organisms
-        self.update_counters()
-        self.spawn_food()
+        killed = self.resolve_combat()
         # Update the list of living organisms
-        self.organisms = living_organisms
+        self.cull(killed)
+        self.update_counters()
+        self.ticks += 1
+
+    def tick(self):
+        self.scheduler.step()
 
 
     def update_counters(self):
-        organism_count = len(self.organisms)
-        food_count = len(self.food)
+        self.telemetry.tick(self.ticks, organisms=len(self.organisms), food=len(self.food),
+                            dead_organisms=self.dead_organisms_count, dead_by_attack=self.dead_by_attack_count,
+                            dead_by_starvation=self.dead_by_starvation_count,
+                            dead_by_fight=self.dead_by_fight_count)
 
-        print(f"Organisms: {organism_count}, Dead organisms: {self.dead_organisms_count}, Dead by attack: {self.dead_by_attack_count}, Dead by starvation: {self.dead_by_starvation_count}, Dead by fight: {self.dead_by_fight_count}, Food: {food_count}")
+    def record_kill(self, killer, victim):
+        self.telemetry.event(self.ticks, "kill", killer.national_id, killer.color)
+        self.telemetry.event(self.ticks, "death", victim.national_id, victim.color, "attack")
 
     def restart_world(self):
-        print("################################################################")
-        print("#")
-        print("#")
-        print("#")
-        print("#")
-        print("WORLD RESTARTING")
-        print("#")
-        print("#")
-        print("#")
-        print("#")
-        print("################################################################")
+        self.telemetry.event(self.ticks, "restart")
         # Destroying current organisms and food
         for organism in self.organisms:
-            organism.shape.visible = False
+            self.renderer.remove(organism)
         self.organisms = []
-
-        for food_item in self.food:
-            food_item.shape.visible = False
-        self.food = []
+        self.food = self.new_food_field()
+        self.grid.clear()
+        self.organism_index.clear()
+        self.watch.clear()
 
         # Creating new organisms and food
-        for i in range(20):
-            x = random.randint(0, self.width - 1)
-
-
-            y = random.randint(0, self.height - 1)
-            z = random.randint(0, self.depth - 1)
-            organism = Organism(self, x, y, z, i)
-            self.world_grid[x][y][z].append(organism)
-            self.organisms.append(organism)
-
-        self.spawn_food_periodically()
+        self.populate()
 
         # Reset counters
         self.dead_organisms_count = 0
@@ -383,19 +487,109 @@ class GameWorld:
             "magenta": 0
         }
 
-        self.update()
+        # Back to tick 0, like a world built anew
+        self.ticks = self.scheduler.steps = 0
 
     def mark_fight_location(self, x, y, z):
-        box(pos=vector(x, y, z), length=1, height=1, width=1, color=color.red)
-
-
-
-# Создаем мир
-scene = canvas(width=1920, height=1080)
-world = GameWorld(width=60, height=60, depth=60, cell_size=10)
-scene.userpan = True
-scene.userzoom = True
-scene.userspin = True
-while True:
-    rate(60)  # Число кадров в секунду, можно изменить по вашему усмотрению
-    world.update()
+        self.renderer.mark_fight(x, y, z)
+
+    def save_snapshot(self, path):
+        numbering = {organism: i for i, organism in enumerate(self.organisms)}
+        columns = snapshot.entity_columns("organism.", self.organisms, ORGANISM_FIELDS)
+        # Genomes shared by several organisms are saved once
+        genomes = {id(organism.genome): organism.genome for organism in self.organisms}
+        genome_numbering = {key: i for i, key in enumerate(genomes)}
+        columns["organism.genome"] = ("q", [genome_numbering[id(organism.genome)] for organism in self.organisms])
+        columns.update(snapshot.entity_columns("genome.", genomes.values(), GENOME_FIELDS))
+        columns["genome.color"] = ("b", [COLORS.index(genome.color) for genome in genomes.values()])
+        columns["food.amount"] = ("f", self.food.amount)
+        for name in ("grid", "organism_index"):
+            columns[name + "_order"] = ("q", snapshot.index_order(getattr(self, name), numbering))
+        meta = {
+            "config": {"width": self.width, "height": self.height, "depth": self.depth, "cell_size": self.cell_size,
+                       "query_cell_size": self.query_cell_size, "initial_organisms": self.initial_organisms,
+                       "food_capacity": self.food_capacity, "food_regrowth": self.food_regrowth,
+                       "trait_ranges": self.trait_ranges, "seed": self.seed,
+                       "timestep": self.timestep, "food_interval": self.food_interval,
+                       "mutation": vars(self.mutation) if self.mutation is not None else None,
+                       "sleep_margin": self.sleep_margin},
+            "engine": "3d",
+            "ticks": self.ticks,
+            "organisms": len(self.organisms),
+            "genomes": len(genomes),
+            "random": self.rng.getstate(),
+            "food_random": self.food.rng.bit_generator.state,
+            "counters": {name: value for name, value in vars(self).items() if name.startswith("dead_by_")
+                         or name == "dead_organisms_count"},
+            "dead_colors_counter": [[key, count] for key, count in self.dead_colors_counter.items()],
+        }
+        snapshot.dump(path, meta, columns)
+
+    @classmethod
+    def load_snapshot(cls, path, renderer=None, telemetry=None):
+        meta, columns = snapshot.load(path, "3d")
+        world = cls(renderer=renderer, telemetry=telemetry, populate=False, **meta["config"])
+        world.ticks = world.scheduler.steps = meta["ticks"]
+        snapshot.set_random_state(world.rng, meta["random"])
+        for name, value in meta["counters"].items():
+            setattr(world, name, value)
+        world.dead_colors_counter = {tuple(key) if isinstance(key, list) else key: count
+                                     for key, count in meta["dead_colors_counter"]}
+
+        world.organisms = snapshot.restore_entities(Organism, "organism.", columns, ORGANISM_FIELDS,
+                                                    meta["organisms"], game_world=world, sleep=None)
+        genomes = snapshot.restore_entities(Genome, "genome.", columns, GENOME_FIELDS, meta["genomes"])
+        for genome, color_index in zip(genomes, columns["genome.color"]):
+            genome.color = COLORS[color_index]
+        for organism, genome_index in zip(world.organisms, columns["organism.genome"]):
+            organism.genome = genomes[genome_index]
+        world.food.restore(np.frombuffer(columns["food.amount"], dtype=np.float32).reshape(world.food.shape))
+        world.food.rng.bit_generator.state = meta["food_random"]
+
+        for name in ("grid", "organism_index"):
+            index = getattr(world, name)
+            for i in columns[name + "_order"]:
+                organism = world.organisms[i]
+                index.insert(organism, organism.x, organism.y, organism.z)
+
+        for organism in world.organisms:
+            world.renderer.add_organism(organism)
+        return world
+
+
+# Phases of a tick for profiling.Profiler; each organism action is a phase of its own
+PROFILE_PHASES = {
+    "tick": [(GameWorld, "update")],
+    "decide": [(Organism, "decide_move")],
+    "perception": [(SpatialHash, "within"), (FoodField, "nearest")],
+    "sleep": [(GameWorld, "still_asleep"), (GameWorld, "disturb"), (SphereWatch, "add"), (SphereWatch, "remove")],
+    "seek food": [(Organism, "move_towards_food")],
+    "eat": [(Organism, "eat_food")],
+    "wander": [(Organism, "move_randomly")],
+    "combat": [(GameWorld, "resolve_combat")],
+    "reproduce": [(Organism, "reproduce")],
+    "movement": [(Organism, "update_position")],
+    "grid": [(SpatialHash, "insert"), (SpatialHash, "move"), (SpatialHash, "remove"), (SpatialHash, "is_occupied")],
+    "food regrowth": [(GameWorld, "grow_food")],
+    "telemetry": [(Telemetry, "tick"), (Telemetry, "event")],
+}
+
+
+def run_gui(profile=False, speed=1.0, frame_rate=60):
+    from vpython import rate
+    from render_vpython import VPythonLODRenderer
+
+    profiler = Profiler(PROFILE_PHASES).enable() if profile else None
+    # Создаем мир
+    renderer = VPythonLODRenderer(profiler=profiler)
+    world = GameWorld(width=60, height=60, depth=60, cell_size=10, renderer=renderer)
+    world.scheduler.speed = speed
+    world.scheduler.frame_rate = frame_rate
+    while True:
+        rate(frame_rate)  # Число кадров в секунду, можно изменить по вашему усмотрению
+        if world.scheduler.advance():
+            renderer.draw(world)
+
+
+if __name__ == "__main__":
+    run_gui()
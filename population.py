@@ -0,0 +1,414 @@
+import sys
+
+import numpy as np
+
+import snapshot
+from genezis_3D import COLORS, TRAIT_RANGES, Mutation
+from renderer import Renderer
+from resources import FoodField
+from scheduler import Scheduler
+from spatial import nearest_within
+from telemetry import Telemetry
+
+GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+
+class Population:
+    # Struct-of-arrays organism store: one contiguous array per attribute, row i
+    # of every array is organism i. Arrays are over-allocated and grow by
+    # doubling, so births are amortised O(1); attribute access returns a view
+    # of the live rows.
+
+    def __init__(self, capacity=64):
+        self.size = 0
+        self.arrays = {
+            "position": np.zeros((capacity, 3)),
+            "energy": np.zeros(capacity),
+            "national_id": np.zeros(capacity, dtype=np.int64),
+            "color": np.zeros(capacity, dtype=np.int8),
+            "uid": np.zeros(capacity, dtype=np.int64),
+        }
+        for name in TRAIT_RANGES:
+            self.arrays[name] = np.zeros(capacity)
+
+    def __getattr__(self, name):
+        arrays = self.__dict__.get("arrays")
+        if arrays is None or name not in arrays:
+            raise AttributeError(name)
+        return arrays[name][:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def append(self, **columns):
+        count = len(columns["position"])
+        capacity = len(self.arrays["energy"])
+        if self.size + count > capacity:
+            capacity = max(2 * capacity, self.size + count)
+            for name, array in self.arrays.items():
+                grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+                grown[:self.size] = array[:self.size]
+                self.arrays[name] = grown
+        for name, array in self.arrays.items():
+            array[self.size:self.size + count] = columns[name]
+        self.size += count
+
+    def keep(self, mask):
+        count = int(np.count_nonzero(mask))
+        for array in self.arrays.values():
+            array[:count] = array[:self.size][mask]
+        self.size = count
+
+
+def mix(x):
+    # splitmix64 finaliser on uint64 arrays; overflow wraps like in C
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class KeyedRandom:
+    # Counter-based random numbers for a batch of organisms: the n-th call
+    # gives every id a hash of (key, tick, stream, n, id), so an organism draws
+    # the same numbers whatever rows, order or process it is simulated in.
+    # Each call returns one value per id (size only adds trailing columns),
+    # with the parts of the numpy Generator interface the world uses.
+
+    def __init__(self, key, tick, ids, stream=0):
+        self.ids = np.asarray(ids).astype(np.uint64) * GOLDEN_GAMMA
+        self.seed = np.array([key], dtype=np.uint64)
+        for value in (tick, stream):
+            self.seed = mix(self.seed ^ np.uint64(value))
+        self.calls = 0
+
+    def _unit(self):
+        self.calls += 1
+        bits = mix(self.ids + mix(self.seed + np.uint64(self.calls)))
+        return (bits >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+    def random(self, size=None):
+        shape = size[1:] if isinstance(size, tuple) else ()
+        if not shape:
+            return self._unit()
+        return np.stack([self._unit() for _ in range(int(np.prod(shape)))], axis=-1).reshape((len(self.ids),) + shape)
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return low + (high - low) * self.random(size)
+
+    def integers(self, low, high, size=None):
+        return low + np.floor(self.random(size) * (high - low)).astype(np.int64)
+
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        # Box-Muller; 1 - u keeps the logarithm finite
+        radius = np.sqrt(-2 * np.log(1 - self.random(size)))
+        return loc + scale * radius * np.cos(2 * np.pi * self.random(size))
+
+
+class VectorGameWorld:
+    # genezis_3D.GameWorld rules applied to the whole population at once:
+    # every organism perceives the world as it was at the start of the tick,
+    # eating conflicts go to the lowest uid, attacks land simultaneously and
+    # the dead are culled once at the end. Cell occupancy is not enforced.
+    # Rows are kept in uid order, and random numbers are drawn per organism
+    # with KeyedRandom, so the outcome of a tick does not depend on how the
+    # population is stored or split up (see tiles.TiledWorld).
+
+    def __init__(self, width=400, height=400, depth=400, cell_size=10, initial_organisms=20,
+                 food_capacity=100, food_regrowth=(5, 20), trait_ranges=None, seed=None, timestep=1 / 60,
+                 food_interval=1 / 60, mutation=None, renderer=None, telemetry=None, populate=True):
+        self.renderer = renderer if renderer is not None else Renderer()
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.initial_organisms = initial_organisms
+        self.food_capacity = food_capacity
+        self.food_regrowth = food_regrowth
+        self.trait_ranges = dict(TRAIT_RANGES, **(trait_ranges or {}))
+        self.mutation = Mutation(**mutation) if isinstance(mutation, dict) else mutation
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.cell_size = cell_size
+        self.size = np.array([width, height, depth])
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.key = int(np.random.SeedSequence(seed).generate_state(1, np.uint64)[0])
+        self.ticks = 0
+        self.next_uid = 0
+
+        self.organisms = Population(max(64, initial_organisms))
+        self.food = self.new_food_field()
+
+        self.dead_organisms_count = 0
+        self.dead_by_attack_count = 0
+        self.dead_by_age_count = 0
+        self.dead_by_fight_count = 0
+        self.dead_by_starvation_count = 0
+        self.dead_colors_counter = {
+            "brown": 0,
+            "blue": 0,
+            "purple": 0,
+            "cyan": 0,
+            "gold": 0,
+            "magenta": 0
+        }
+
+        self.timestep = timestep
+        self.food_interval = food_interval
+        # Food spawning and the organisms' update are jobs on one fixed-timestep clock
+        self.scheduler = Scheduler(timestep)
+        self.scheduler.every(timestep, self.update)
+        self.scheduler.every(food_interval, self.grow_food)
+
+        if populate:
+            self.spawn_organisms(initial_organisms)
+
+    def spawn_organisms(self, count):
+        columns = {
+            "position": self.rng.integers(0, self.size, size=(count, 3)),
+            "national_id": np.arange(count),
+            "color": self.rng.integers(0, len(COLORS), size=count),
+            "uid": self.new_uids(count),
+        }
+        for name, bounds in self.trait_ranges.items():
+            if bounds is None:
+                columns[name] = self.rng.random(count)
+            else:
+                columns[name] = self.rng.integers(bounds[0], bounds[1] + 1, size=count)
+        columns["energy"] = columns["basic_energy_amount"]
+        self.organisms.append(**columns)
+
+    def new_food_field(self):
+        return FoodField(self.width, self.height, self.depth, self.cell_size, self.food_capacity, self.food_regrowth,
+                         rng=self.rng)
+
+    def grow_food(self):
+        return self.food.regrow()
+
+    def add_food(self, cells):
+        # Food put down from outside the simulation (control.py)
+        self.food.fill(cells)
+
+    def new_uids(self, count):
+        uids = np.arange(self.next_uid, self.next_uid + count)
+        self.next_uid += count
+        return uids
+
+    def clamp(self, position):
+        return np.clip(position, 0, self.size - 1)
+
+    def update(self):
+        pop = self.organisms
+        n = len(pop)
+        draws = KeyedRandom(self.key, self.ticks, pop.uid)
+
+        # Perception
+        food_cell, _ = self.food.nearest_many(pop.position, pop.radius_of_sight)
+        nearest_enemy, _ = nearest_within(pop.position, pop.radius_of_sight, pop.position, accept=self.is_enemy)
+
+        # Decisions, in the same order as Organism.decide_move
+        food_in_sight = food_cell[:, 0] >= 0
+        attacking = ~food_in_sight & (nearest_enemy >= 0) & (draws.random(n) < pop.attack_chance)
+        wandering = ~food_in_sight & ~attacking & (draws.random(n) < pop.random_move_chance)
+        idle = ~food_in_sight & ~attacking & ~wandering
+
+        seekers, target = self.move(food_cell, food_in_sight, wandering, draws)
+
+        # Eating: a food cell goes to the first organism that reached it
+        reached = np.linalg.norm(pop.position[seekers] - target, axis=1) < self.cell_size
+        eaters = seekers[reached]
+        eaten, first = np.unique(food_cell[eaters], axis=0, return_index=True)
+        eaters = eaters[first]
+        self.eat(eaters, eaten)
+
+        parents = np.sort(eaters[pop.energy[eaters] > 2 * pop.basic_energy_amount[eaters]])
+
+        self.spend_energy(food_in_sight, wandering, idle)
+        killed = self.fight(attacking)
+        starved = np.flatnonzero(pop.energy <= 0)
+        self.record_events("death", starved[~np.isin(starved, killed)], "starvation")
+
+        self.reproduce(parents)
+        self.record_events("birth", parents)
+        # Death culling, once per tick
+        self.organisms.keep(self.organisms.energy > 0)
+        self.update_counters()
+        self.ticks += 1
+
+    def is_enemy(self, query, target):
+        # nearest_within() accept test between rows of the population
+        pop = self.organisms
+        return (pop.national_id[query] != pop.national_id[target]) & (pop.color[query] != pop.color[target])
+
+    def move(self, food_cell, food_in_sight, wandering, draws):
+        # Moves the organisms with food in sight towards it and the wandering
+        # ones randomly; returns the rows that moved towards food and the
+        # centres of their cells
+        pop = self.organisms
+        position = pop.position
+
+        # Movement towards food; the z step reuses cos like Organism.move_towards_food
+        seekers = np.flatnonzero(food_in_sight)
+        target = self.food.centres(food_cell[seekers])
+        angle = np.arctan2(target[:, 1] - position[seekers, 1], target[:, 0] - position[seekers, 0])
+        step = pop.speed[seekers, None] * np.stack([np.cos(angle), np.sin(angle), np.cos(angle)], axis=1)
+        moved = position[seekers] + step
+        inside = np.all((moved >= 0) & (moved < self.size), axis=1)
+        seekers, moved, target = seekers[inside], moved[inside], target[inside]
+        position[seekers] = moved
+
+        # Random walk: two clamped steps like Organism.move_randomly
+        walkers = np.flatnonzero(wandering)
+        speed = pop.speed[walkers, None]
+        for rounded in (False, True):
+            angle = draws.uniform(0, 2 * np.pi, len(pop))[walkers]
+            moved = position[walkers] + speed * np.stack([np.cos(angle), np.sin(angle), np.sin(angle)], axis=1)
+            position[walkers] = self.clamp(np.round(moved) if rounded else moved)
+        return seekers, target
+
+    def spend_energy(self, food_in_sight, wandering, idle):
+        pop = self.organisms
+        energy = pop.energy
+        energy[food_in_sight] -= pop.speed[food_in_sight] * pop.energy_run_spending[food_in_sight]
+        energy[wandering] -= pop.speed[wandering] * pop.energy_find_walk_spending[wandering]
+        energy[idle] -= pop.energy_idle_spending[idle]
+
+    def fight(self, attacking):
+        # Every attacker hits the nearest enemy within its attack radius that
+        # did not starve this tick, all hits land at once, and survivors
+        # strike back. Returns the rows killed.
+        pop = self.organisms
+        energy = pop.energy
+        alive_before = energy > 0
+        attackers = np.flatnonzero(attacking)
+
+        def is_living_enemy(query, target):
+            return self.is_enemy(attackers[query], target) & alive_before[target]
+
+        targets, _ = nearest_within(pop.position[attackers], pop.attack_radius[attackers], pop.position,
+                                    accept=is_living_enemy)
+        attackers, targets = attackers[targets >= 0], targets[targets >= 0]
+        np.subtract.at(energy, targets, pop.attack_damage[attackers])
+        survived = energy[targets] > 0
+        np.subtract.at(energy, attackers[survived], pop.attack_damage[targets[survived]])
+        fought = np.zeros(len(pop), dtype=bool)
+        fought[attackers] = True
+        fought[targets] = True
+        killed = np.flatnonzero(fought & alive_before & (energy <= 0))
+        self.count_kills(killed)
+        # Every victim is credited once, to the first pair it lost in, as in
+        # GameWorld.resolve_combat: a target to its attacker, an attacker to its target
+        victims = np.stack([targets, attackers], axis=1).reshape(-1)
+        killers = np.stack([attackers, targets], axis=1).reshape(-1)
+        lost = np.isin(victims, killed)
+        _, first = np.unique(victims[lost], return_index=True)
+        self.record_events("kill", killers[lost][np.sort(first)])
+        self.record_events("death", killed, "attack")
+        return killed
+
+    def tick(self):
+        self.scheduler.step()
+
+    def eat(self, eaters, cells):
+        self.organisms.energy[eaters] += self.food.take_many(cells)
+
+    def count_kills(self, killed):
+        pop = self.organisms
+        self.dead_organisms_count += len(killed)
+        self.dead_by_attack_count += len(killed)
+        colors, counts = np.unique(pop.color[killed], return_counts=True)
+        for color_index, count in zip(colors, counts):
+            color_tuple = COLORS[color_index]
+            self.dead_colors_counter[color_tuple] = self.dead_colors_counter.get(color_tuple, 0) + int(count)
+        for x, y, z in pop.position[killed]:
+            self.renderer.mark_fight(x, y, z)
+
+    def record_events(self, kind, rows, detail=None):
+        pop = self.organisms
+        for national_id, color_index in zip(pop.national_id[rows].tolist(), pop.color[rows].tolist()):
+            self.telemetry.event(self.ticks, kind, national_id, COLORS[color_index], detail)
+
+    def reproduce(self, parents):
+        pop = self.organisms
+        if len(parents) == 0:
+            return
+        columns = {name: array[parents] for name, array in pop.arrays.items() if name in TRAIT_RANGES}
+        # Drawn per parent, so a child does not depend on its uid
+        draws = KeyedRandom(self.key, self.ticks, pop.uid[parents], stream=1)
+        offset = draws.integers(-5, 6, size=(len(parents), 3))
+        columns["position"] = np.floor(self.clamp(pop.position[parents] + offset))
+        columns["national_id"] = pop.national_id[parents]
+        columns["color"] = pop.color[parents]
+        if self.mutation is not None:
+            self.mutation.mutate_columns(columns, draws, self.trait_ranges)
+        columns["uid"] = self.new_uids(len(parents))
+        columns["energy"] = columns["basic_energy_amount"]
+        pop.append(**columns)
+
+    def update_counters(self, organisms=None):
+        organisms = len(self.organisms) if organisms is None else organisms
+        self.telemetry.tick(self.ticks, organisms=organisms, food=len(self.food),
+                            dead_organisms=self.dead_organisms_count, dead_by_attack=self.dead_by_attack_count,
+                            dead_by_starvation=self.dead_by_starvation_count,
+                            dead_by_fight=self.dead_by_fight_count)
+
+    def config(self):
+        return {"width": self.width, "height": self.height, "depth": self.depth, "cell_size": self.cell_size,
+                "initial_organisms": self.initial_organisms, "food_capacity": self.food_capacity,
+                "food_regrowth": self.food_regrowth, "trait_ranges": self.trait_ranges, "seed": self.seed,
+                "timestep": self.timestep, "food_interval": self.food_interval,
+                "mutation": vars(self.mutation) if self.mutation is not None else None}
+
+    def save_snapshot(self, path):
+        typecodes = {np.dtype(np.float64): "d", np.dtype(np.int64): "q", np.dtype(np.int8): "b"}
+        columns = {"organism." + name: (typecodes[array.dtype], np.ascontiguousarray(array[:len(self.organisms)]))
+                   for name, array in self.organisms.arrays.items()}
+        columns["food.amount"] = ("f", self.food.amount)
+        meta = {
+            "engine": "vectorized",
+            "config": self.config(),
+            "ticks": self.ticks,
+            "organisms": len(self.organisms),
+            "random": self.rng.bit_generator.state,
+            "key": self.key,
+            "next_uid": self.next_uid,
+            "counters": {name: value for name, value in vars(self).items() if name.startswith("dead_by_")
+                         or name == "dead_organisms_count"},
+            "dead_colors_counter": [[key, count] for key, count in self.dead_colors_counter.items()],
+        }
+        snapshot.dump(path, meta, columns)
+
+    @classmethod
+    def load_snapshot(cls, path, renderer=None, telemetry=None):
+        meta, columns = snapshot.load(path, "vectorized")
+        world = cls(renderer=renderer, telemetry=telemetry, populate=False, **meta["config"])
+        world.ticks = world.scheduler.steps = meta["ticks"]
+        world.rng.bit_generator.state = meta["random"]
+        world.key = meta["key"]
+        world.next_uid = meta["next_uid"]
+        for name, value in meta["counters"].items():
+            setattr(world, name, value)
+        world.dead_colors_counter = {tuple(key) if isinstance(key, list) else key: count
+                                     for key, count in meta["dead_colors_counter"]}
+
+        count = meta["organisms"]
+        world.organisms = Population(max(64, count))
+        world.organisms.append(**{name: np.frombuffer(columns["organism." + name], dtype=array.dtype)
+                                  .reshape((count,) + array.shape[1:])
+                                  for name, array in world.organisms.arrays.items()})
+        world.food.restore(np.frombuffer(columns["food.amount"], dtype=np.float32).reshape(world.food.shape))
+        return world
+
+
+# Phases of a tick for profiling.Profiler. Decisions and finding the
+# organisms that reached their food are left in update, the "tick" phase.
+PROFILE_PHASES = {
+    "tick": [(VectorGameWorld, "update")],
+    "perception": [(sys.modules[__name__], "nearest_within"), (FoodField, "nearest_many")],
+    "movement": [(VectorGameWorld, "move")],
+    "eating": [(VectorGameWorld, "eat")],
+    "energy": [(VectorGameWorld, "spend_energy")],
+    "combat": [(VectorGameWorld, "fight")],
+    "kills": [(VectorGameWorld, "count_kills")],
+    "reproduce": [(VectorGameWorld, "reproduce")],
+    "food regrowth": [(VectorGameWorld, "grow_food")],
+    "telemetry": [(VectorGameWorld, "record_events"), (Telemetry, "tick")],
+}
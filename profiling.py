@@ -0,0 +1,114 @@
+import cProfile
+import time
+from collections import defaultdict
+
+
+class Profiler:
+    # Per-phase timers and call counts for a world engine. `phases` maps a
+    # phase name to the (class or module, function name) pairs that make it up
+    # and must contain a "tick" phase for the function that runs one tick.
+    # While enabled those functions are replaced by timed wrappers; disabled,
+    # the originals are put back, so the engine runs at full speed. Time spent
+    # in a nested timed call is charged to the nested phase only, so the
+    # "tick" phase is what the listed phases don't cover.
+    # The wrappers are installed on the classes, so an enabled profiler sees
+    # every world of that engine in the process.
+
+    def __init__(self, phases):
+        self.phases = phases
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.nested = []
+        self.patched = []
+        self.capture = None
+
+    @property
+    def enabled(self):
+        return bool(self.patched)
+
+    def enable(self):
+        if self.patched:
+            return self
+        for phase, targets in self.phases.items():
+            for owner, name in targets:
+                original = vars(owner)[name]
+                self.patched.append((owner, name, original))
+                wrapper = self.wrap_tick(original) if phase == "tick" else original
+                setattr(owner, name, self.wrap(phase, wrapper))
+        return self
+
+    def disable(self):
+        if self.capture is not None:
+            self.dump()
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *exc_info):
+        self.disable()
+
+    def reset(self):
+        self.seconds.clear()
+        self.calls.clear()
+
+    def wrap(self, phase, function):
+        clock = time.perf_counter
+        seconds, calls, nested = self.seconds, self.calls, self.nested
+
+        def timed(*args, **kwargs):
+            nested.append(0.0)
+            started = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = clock() - started
+                seconds[phase] += elapsed - nested.pop()
+                calls[phase] += 1
+                if nested:
+                    nested[-1] += elapsed
+        return timed
+
+    def wrap_tick(self, function):
+        def tick(world, *args, **kwargs):
+            if self.capture is None:
+                return function(world, *args, **kwargs)
+            first, last, path, profile = self.capture
+            if not first <= world.ticks < last:
+                return function(world, *args, **kwargs)
+            profile.enable()
+            try:
+                return function(world, *args, **kwargs)
+            finally:
+                profile.disable()
+                if world.ticks >= last:
+                    self.dump()
+        return tick
+
+    def profile_ticks(self, first, last, path):
+        # Runs cProfile for ticks first <= tick < last and writes the result to
+        # path (readable with pstats or snakeviz) once tick `last` is reached,
+        # or what it got of them when the profiler is disabled before that
+        self.capture = (first, last, path, cProfile.Profile())
+        return self.enable()
+
+    def dump(self):
+        _, _, path, profile = self.capture
+        self.capture = None
+        # pstats can't read the dump of a profile that never ran
+        if profile.getstats():
+            profile.dump_stats(path)
+
+    def stats(self):
+        # {phase: (total seconds, calls, milliseconds per tick)}, slowest first
+        ticks = self.calls["tick"] or 1
+        return {phase: (self.seconds[phase], self.calls[phase], 1000 * self.seconds[phase] / ticks)
+                for phase in sorted(self.seconds, key=self.seconds.get, reverse=True)}
+
+    def report(self):
+        lines = [f"{self.calls['tick']} ticks"]
+        for phase, (_, calls, ms_per_tick) in self.stats().items():
+            lines.append(f"{phase:<16}{ms_per_tick:9.3f} ms/tick {calls:>10} calls")
+        return "\n".join(lines)
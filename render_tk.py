@@ -0,0 +1,179 @@
+import tkinter as tk
+
+import numpy as np
+
+from renderer import Renderer
+
+
+class TkRenderer(Renderer):
+    def __init__(self, canvas, profiler=None):
+        self.canvas = canvas
+        self.items = {}
+        self.profiler = profiler
+        self.overlay = None
+
+    def add_organism(self, organism):
+        x, y = organism.x, organism.y
+        self.items[organism] = self.canvas.create_rectangle(x - 5, y - 5, x + 5, y + 5, fill="blue")
+
+    def add_food(self, food):
+        x, y = food.x, food.y
+        self.items[food] = self.canvas.create_oval(x - 5, y - 5, x + 5, y + 5, fill="green")
+
+    def move(self, entity):
+        x, y = entity.x, entity.y
+        self.canvas.coords(self.items[entity], x - 5, y - 5, x + 5, y + 5)
+
+    def remove(self, entity):
+        item = self.items.pop(entity, None)
+        if item is not None:
+            self.canvas.delete(item)
+
+    def draw(self, world):
+        if self.profiler is not None:
+            if self.overlay is None:
+                self.overlay = self.canvas.create_text(5, 5, anchor="nw", font=("Courier", 8))
+            self.canvas.itemconfigure(self.overlay, text=self.profiler.report())
+            self.canvas.tag_raise(self.overlay)
+
+
+def dilate(mask, half_widths):
+    # Every pixel within the shape around a set pixel of mask: row dy of the
+    # shape (dy from -r to r) spans half_widths[dy + r] pixels to each side
+    radius = len(half_widths) // 2
+    rows = [mask]
+    for k in range(1, max(half_widths) + 1):
+        row = rows[-1].copy()
+        row[:, k:] |= mask[:, :-k]
+        row[:, :-k] |= mask[:, k:]
+        rows.append(row)
+    out = np.zeros_like(mask)
+    for dy, width in enumerate(half_widths, -radius):
+        row = rows[width]
+        if dy >= 0:
+            out[dy:] |= row[:len(row) - dy]
+        else:
+            out[:dy] |= row[-dy:]
+    return out
+
+
+class Raster:
+    # Positions of everything on screen in flat arrays, painted into an RGB
+    # pixel buffer. Shapes are stamped by dilating a mask of the centres, so a
+    # frame costs about the same for ten entities or a hundred thousand.
+
+    BACKGROUND = (255, 255, 255)
+    # kind: (colour, shape)
+    KINDS = {1: ((0, 160, 0), "disk"), 2: ((0, 0, 255), "square")}
+
+    def __init__(self, width, height, radius=5, capacity=1024):
+        self.width = width
+        self.height = height
+        self.slots = {}
+        # Unused slots, lowest last so it is handed out first
+        self.free = list(range(capacity - 1, -1, -1))
+        self.position = np.zeros((capacity, 2))
+        self.kind = np.zeros(capacity, dtype=np.int8)
+        self.shapes = {
+            "square": [radius] * (2 * radius + 1),
+            "disk": [int((radius * radius - dy * dy) ** 0.5) for dy in range(-radius, radius + 1)],
+        }
+
+    def add(self, entity, kind):
+        if not self.free:
+            size = len(self.kind)
+            self.position = np.concatenate([self.position, np.zeros_like(self.position)])
+            self.kind = np.concatenate([self.kind, np.zeros_like(self.kind)])
+            self.free = list(range(2 * size - 1, size - 1, -1))
+        slot = self.free.pop()
+        self.slots[entity] = slot
+        self.kind[slot] = kind
+        self.position[slot] = entity.x, entity.y
+
+    def move(self, entity):
+        slot = self.slots.get(entity)
+        if slot is not None:
+            self.position[slot] = entity.x, entity.y
+
+    def remove(self, entity):
+        slot = self.slots.pop(entity, None)
+        if slot is not None:
+            self.kind[slot] = 0
+            self.free.append(slot)
+
+    def paint(self):
+        frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        frame[...] = self.BACKGROUND
+        # Later kinds are painted over earlier ones
+        for kind, (color, shape) in self.KINDS.items():
+            x, y = np.round(self.position[self.kind == kind]).astype(np.intp).T
+            inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+            centres = np.zeros((self.height, self.width), dtype=bool)
+            centres[y[inside], x[inside]] = True
+            frame[dilate(centres, self.shapes[shape])] = color
+        return frame
+
+
+def dirty_rects(frame, previous, tile=32):
+    # Rectangles (x0, y0, x1, y1) covering the tiles where frame differs from
+    # previous, one per horizontal run of changed tiles
+    changed = np.any(frame != previous, axis=2)
+    rows = np.arange(0, changed.shape[0], tile)
+    columns = np.arange(0, changed.shape[1], tile)
+    tiles = np.logical_or.reduceat(np.logical_or.reduceat(changed, rows, axis=0), columns, axis=1)
+    rects = []
+    for i, row in enumerate(tiles):
+        edges = np.flatnonzero(np.diff(np.concatenate([[False], row, [False]]).astype(np.int8)))
+        for first, last in zip(edges[::2].tolist(), edges[1::2].tolist()):
+            rects.append((first * tile, i * tile, min(last * tile, frame.shape[1]), min((i + 1) * tile,
+                                                                                        frame.shape[0])))
+    return rects
+
+
+class TkRasterRenderer(TkRenderer):
+    # Draws the world as one PhotoImage instead of a canvas item per entity,
+    # which keeps Tk's per-item cost out of the frame. Each frame is painted
+    # by a Raster and handed to Tk as binary PPM data; with dirty_rects only
+    # the tiles that changed since the previous frame are sent, unless most
+    # of them did.
+
+    def __init__(self, canvas, profiler=None, dirty_rects=True, tile=32):
+        super().__init__(canvas, profiler)
+        self.raster = Raster(int(canvas["width"]), int(canvas["height"]))
+        self.image = tk.PhotoImage(master=canvas, width=self.raster.width, height=self.raster.height)
+        canvas.create_image(0, 0, anchor="nw", image=self.image)
+        self.dirty_rects = dirty_rects
+        self.tile = tile
+        self.shown = None
+
+    def add_organism(self, organism):
+        self.raster.add(organism, 2)
+
+    def add_food(self, food):
+        self.raster.add(food, 1)
+
+    def move(self, entity):
+        self.raster.move(entity)
+
+    def remove(self, entity):
+        self.raster.remove(entity)
+
+    def blit(self, frame, x=0, y=0):
+        height, width = frame.shape[:2]
+        data = b"P6 %d %d 255\n" % (width, height) + frame.tobytes()
+        self.canvas.tk.call(self.image.name, "put", data, "-format", "ppm", "-to", x, y)
+
+    def draw(self, world):
+        frame = self.raster.paint()
+        rects = None
+        if self.dirty_rects and self.shown is not None:
+            rects = dirty_rects(frame, self.shown, self.tile)
+            if sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in rects) > frame.shape[0] * frame.shape[1] // 2:
+                rects = None
+        if rects is None:
+            self.blit(frame)
+        else:
+            for x0, y0, x1, y1 in rects:
+                self.blit(frame[y0:y1, x0:x1], x0, y0)
+        self.shown = frame
+        super().draw(world)
@@ -0,0 +1,284 @@
+from collections import deque
+
+import numpy as np
+from vpython import box, canvas, color, label, points, sphere, vector
+
+from renderer import Renderer
+
+
+class ShapePool:
+    # vpython never frees an object in the browser, even after delete(), so
+    # shapes of dead organisms and eaten food are hidden and handed to the
+    # next entity instead. At most `capacity` idle shapes are kept around.
+
+    def __init__(self, factory, capacity=1000):
+        self.factory = factory
+        self.capacity = capacity
+        self.idle = []
+        self.created = 0
+
+    def acquire(self, **attributes):
+        if self.idle:
+            shape = self.idle.pop()
+            for name, value in attributes.items():
+                setattr(shape, name, value)
+            shape.visible = True
+            return shape
+        self.created += 1
+        return self.factory(**attributes)
+
+    def release(self, shape):
+        shape.visible = False
+        if len(self.idle) < self.capacity:
+            self.idle.append(shape)
+        else:
+            shape.delete()
+
+
+class FightMarkers:
+    # Red boxes where organisms died in a fight. Only the newest `limit` are
+    # shown; each fades out over `lifetime` frames and its box is reused.
+
+    def __init__(self, limit=200, lifetime=300):
+        self.lifetime = lifetime
+        self.markers = deque()
+        self.pool = ShapePool(lambda **attributes: box(length=1, height=1, width=1, color=color.red, **attributes),
+                              capacity=limit)
+        self.limit = limit
+
+    def add(self, x, y, z):
+        if len(self.markers) >= self.limit:
+            self.pool.release(self.markers.popleft()[0])
+        self.markers.append([self.pool.acquire(pos=vector(x, y, z), opacity=1), 0])
+
+    def decay(self):
+        for marker in self.markers:
+            marker[1] += 1
+            marker[0].opacity = 1 - marker[1] / self.lifetime
+        while self.markers and self.markers[0][1] >= self.lifetime:
+            self.pool.release(self.markers.popleft()[0])
+
+
+class VPythonRenderer(Renderer):
+    def __init__(self, scene=None, pool_capacity=1000, fight_marker_limit=200, fight_marker_lifetime=300,
+                 profiler=None, overlay_every=30):
+        if scene is None:
+            scene = canvas(width=1920, height=1080)
+            scene.userpan = True
+            scene.userzoom = True
+            scene.userspin = True
+        self.scene = scene
+        self.shapes = {}
+        self.spheres = ShapePool(sphere, capacity=pool_capacity)
+        self.fights = FightMarkers(fight_marker_limit, fight_marker_lifetime)
+        # Cells of the food field that currently have a sphere
+        self.food_shapes = {}
+        # The field's ripe index as last drawn
+        self.food_shown = np.zeros(0, dtype=np.int64)
+        self.profiler = profiler
+        self.overlay = None
+        # Frames between overlay refreshes; every text change is sent to the browser
+        self.overlay_every = overlay_every
+        self.frames = 0
+
+    def add_organism(self, organism):
+        self.shapes[organism] = self.spheres.acquire(pos=vector(organism.x, organism.y, organism.z), radius=5,
+                                                     color=vector(*organism.color))
+
+    def move(self, entity):
+        self.shapes[entity].pos = vector(entity.x, entity.y, entity.z)
+
+    def remove(self, entity):
+        shape = self.shapes.pop(entity, None)
+        if shape is not None:
+            self.spheres.release(shape)
+
+    def mark_fight(self, x, y, z=0):
+        self.fights.add(x, y, z)
+
+    def food_changes(self, field):
+        # Cells that ripened and cells that were eaten since the last frame
+        ripe = field.ripe
+        added = field.cells(np.setdiff1d(ripe, self.food_shown, assume_unique=True))
+        removed = field.cells(np.setdiff1d(self.food_shown, ripe, assume_unique=True))
+        self.food_shown = ripe
+        return map(tuple, added.tolist()), map(tuple, removed.tolist())
+
+    def draw_food(self, field):
+        # One sphere per cell that holds food; only cells that ripened or were
+        # eaten since the last frame are touched
+        added, removed = self.food_changes(field)
+        for cell in removed:
+            self.spheres.release(self.food_shapes.pop(cell))
+        for cell in added:
+            self.food_shapes[cell] = self.spheres.acquire(pos=vector(*field.centre(cell)), radius=3,
+                                                          color=color.green)
+
+    def draw(self, world):
+        self.draw_food(world.food)
+        self.fights.decay()
+        self.frames += 1
+        if self.profiler is not None and self.frames % self.overlay_every == 0:
+            if self.overlay is None:
+                self.overlay = label(canvas=self.scene, pixel_pos=True, pos=vector(10, self.scene.height - 10, 0),
+                                     align="left", box=False, font="monospace", height=11, text="")
+            self.overlay.text = self.profiler.report().replace("\n", "<br>")
+
+
+class PointBatch:
+    # Many entities drawn by one vpython points object, one point each.
+    # Removing moves the last point into the hole, so every change is a
+    # single point update; moves are queued and flush() sends at most
+    # `limit` of them, the longest waiting first.
+
+    def __init__(self, scene, point_color, radius):
+        self.shape = points(canvas=scene, color=point_color, radius=radius, size_units="world")
+        self.keys = []
+        self.index = {}
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, items):
+        # items: [(key, (x, y, z))], sent to the browser in one message
+        if not items:
+            return
+        for key, _ in items:
+            self.index[key] = len(self.keys)
+            self.keys.append(key)
+        self.shape.append(pos=[vector(*position) for _, position in items])
+
+    def move(self, key, position):
+        self.pending[key] = position
+
+    def remove(self, key):
+        i = self.index.pop(key)
+        self.pending.pop(key, None)
+        last = self.keys.pop()
+        if i < len(self.keys):
+            self.keys[i] = last
+            self.index[last] = i
+            self.shape.modify(i, self.shape.point(len(self.keys))["pos"])
+        self.shape.pop()
+
+    def position(self, key):
+        pos = self.shape.point(self.index[key])["pos"]
+        return pos.x, pos.y, pos.z
+
+    def flush(self, limit):
+        sent = 0
+        while self.pending and sent < limit:
+            key = next(iter(self.pending))
+            self.shape.modify(self.index[key], vector(*self.pending.pop(key)))
+            sent += 1
+        return sent
+
+    def clear(self):
+        self.shape.clear()
+        self.shape.visible = False
+
+
+class VPythonLODRenderer(VPythonRenderer):
+    # VPythonRenderer that switches to PointBatch objects, one per colour (or
+    # per `group_by` attribute such as national_id), once more than
+    # `threshold` organisms and food cells are on screen, and back to spheres
+    # below three quarters of it. In point mode a move only queues the new
+    # position and each frame sends at most `max_updates` of them, spread
+    # over the batches in turn, so the browser always gets a bounded amount
+    # of work per frame however large the population.
+
+    def __init__(self, scene=None, threshold=2000, group_by="color", max_updates=2000, point_radius=2, **kwargs):
+        super().__init__(scene, **kwargs)
+        self.threshold = threshold
+        self.group_by = group_by
+        self.max_updates = max_updates
+        self.point_radius = point_radius
+        # {entity: batch} in point mode, None while drawing spheres
+        self.batched = None
+        self.batches = {}
+        self.food_batch = None
+        self.turn = 0
+
+    def batch_for(self, entity):
+        group = getattr(entity, self.group_by, entity.color)
+        batch = self.batches.get(group)
+        if batch is None:
+            batch = self.batches[group] = PointBatch(self.scene, vector(*entity.color), self.point_radius)
+        return batch
+
+    def add_organism(self, organism):
+        if self.batched is None:
+            return super().add_organism(organism)
+        batch = self.batch_for(organism)
+        batch.add([(organism, (organism.x, organism.y, organism.z))])
+        self.batched[organism] = batch
+
+    def move(self, entity):
+        if self.batched is None:
+            return super().move(entity)
+        batch = self.batched.get(entity)
+        if batch is not None:
+            batch.move(entity, (entity.x, entity.y, entity.z))
+
+    def remove(self, entity):
+        if self.batched is None:
+            return super().remove(entity)
+        batch = self.batched.pop(entity, None)
+        if batch is not None:
+            batch.remove(entity)
+
+    def shown(self):
+        if self.batched is None:
+            return len(self.shapes) + len(self.food_shapes)
+        return len(self.batched) + len(self.food_batch)
+
+    def to_points(self):
+        self.batched = {}
+        groups = {}
+        for entity, shape in self.shapes.items():
+            self.spheres.release(shape)
+            groups.setdefault(self.batch_for(entity), []).append((entity, (entity.x, entity.y, entity.z)))
+        for batch, items in groups.items():
+            batch.add(items)
+            self.batched.update((entity, batch) for entity, _ in items)
+        self.shapes = {}
+        self.food_batch = PointBatch(self.scene, color.green, self.point_radius)
+        self.food_batch.add([(cell, (shape.pos.x, shape.pos.y, shape.pos.z)) for cell, shape in self.food_shapes.items()])
+        for shape in self.food_shapes.values():
+            self.spheres.release(shape)
+        self.food_shapes = {}
+
+    def to_spheres(self):
+        batched, self.batched = self.batched, None
+        for entity, batch in batched.items():
+            super().add_organism(entity)
+        for cell in self.food_batch.keys:
+            self.food_shapes[cell] = self.spheres.acquire(pos=vector(*self.food_batch.position(cell)), radius=3,
+                                                          color=color.green)
+        for batch in [*self.batches.values(), self.food_batch]:
+            batch.clear()
+        self.batches = {}
+        self.food_batch = None
+
+    def draw_food(self, field):
+        if self.batched is None:
+            return super().draw_food(field)
+        added, removed = self.food_changes(field)
+        for cell in removed:
+            self.food_batch.remove(cell)
+        self.food_batch.add([(cell, field.centre(cell)) for cell in added])
+
+    def draw(self, world):
+        shown = self.shown()
+        if self.batched is None and shown > self.threshold:
+            self.to_points()
+        elif self.batched is not None and shown < self.threshold * 3 // 4:
+            self.to_spheres()
+        super().draw(world)
+        if self.batched is not None:
+            batches = list(self.batches.values())
+            budget = self.max_updates
+            for i in range(len(batches)):
+                budget -= batches[(self.turn + i) % len(batches)].flush(budget)
+            self.turn += 1
@@ -0,0 +1,22 @@
+class Renderer:
+    # Observer that a GameWorld notifies about everything visible that happens
+    # in it. The base class draws nothing, which is what headless runs use;
+    # the tkinter and vpython front-ends override what they need.
+
+    def add_organism(self, organism):
+        pass
+
+    def add_food(self, food):
+        pass
+
+    def move(self, entity):
+        pass
+
+    def remove(self, entity):
+        pass
+
+    def mark_fight(self, x, y, z=0):
+        pass
+
+    def draw(self, world):
+        pass
@@ -0,0 +1,419 @@
+import argparse
+import bisect
+import itertools
+import os
+import struct
+
+import numpy as np
+
+import snapshot
+from genezis_3D import COLORS
+from renderer import Renderer
+from resources import FoodField
+from scheduler import Scheduler
+
+# File layout: MAGIC, format version, then records of (payload size, tick,
+# kind) followed by a snapshot.pack() payload. The first record is the
+# header; after it every tick is either a keyframe with the full state or a
+# delta against the tick before. Records are self-delimiting, so a log that
+# was cut off is still readable up to its last complete record.
+MAGIC = b"GNZR"
+VERSION = 1
+RECORD = struct.Struct("<IqB")
+HEADER, KEYFRAME, DELTA = 0, 1, 2
+
+COLOR_INDEX = {color: i for i, color in enumerate(COLORS)}
+
+
+def positions(entities, three_d):
+    if three_d:
+        return np.array([(entity.x, entity.y, entity.z) for entity in entities], dtype=np.float32).reshape(-1, 3)
+    return np.array([(entity.x, entity.y, 0) for entity in entities], dtype=np.float32).reshape(-1, 3)
+
+
+class Recorder(Renderer):
+    # Writes what a world looks like after every tick to a replay log. It
+    # sits between the world and its renderer, passing every call on, to see
+    # the fights; everything else is read from the world at the end of each
+    # tick by a job on the world's scheduler. Organisms and food are compared
+    # with the previous tick by id, so a delta only holds births, deaths,
+    # moves and food that appeared or was eaten. Every `keyframe_every` ticks
+    # the full state is written instead, which is what makes seeking cheap.
+
+    def __init__(self, path, keyframe_every=100):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + struct.pack("<H", VERSION))
+        self.keyframe_every = keyframe_every
+        self.renderer = Renderer()
+        self.world = None
+        self.numbering = {}
+        self.next_id = itertools.count()
+        self.fights = []
+        self.previous = None
+        self.first_tick = None
+
+    def attach(self, world):
+        self.world = world
+        self.renderer, world.renderer = world.renderer, self
+        field = world.food if isinstance(world.food, FoodField) else None
+        meta = {
+            "width": world.width, "height": world.height, "depth": getattr(world, "depth", None),
+            "timestep": world.timestep, "keyframe_every": self.keyframe_every,
+            "food_field": None if field is None else {"cell_size": field.cell_size, "minimum": field.minimum},
+        }
+        self.write(world.ticks, HEADER, meta, {})
+        self.first_tick = world.ticks
+        self.capture()
+        world.scheduler.every(world.timestep, self.capture)
+        return self
+
+    def add_organism(self, organism):
+        self.renderer.add_organism(organism)
+
+    def add_food(self, food):
+        self.renderer.add_food(food)
+
+    def move(self, entity):
+        self.renderer.move(entity)
+
+    def remove(self, entity):
+        self.renderer.remove(entity)
+
+    def mark_fight(self, x, y, z=0):
+        self.fights.append((x, y, z))
+        self.renderer.mark_fight(x, y, z)
+
+    def draw(self, world):
+        self.renderer.draw(world)
+
+    def ids(self, entities, numbering):
+        # Objects keep the id they got when first seen
+        ids = []
+        for entity in entities:
+            i = self.numbering.get(entity)
+            numbering[entity] = i = next(self.next_id) if i is None else i
+            ids.append(i)
+        return np.array(ids, dtype=np.int64)
+
+    def state(self):
+        # Organisms and food of the world as id-sorted arrays
+        world = self.world
+        three_d = getattr(world, "depth", None) is not None
+        organisms = world.organisms
+        numbering = {}
+        if hasattr(organisms, "arrays"):
+            # VectorGameWorld / TiledWorld population
+            ids, position, color = organisms.uid, organisms.position.astype(np.float32), organisms.color
+        else:
+            ids = self.ids(organisms, numbering)
+            position = positions(organisms, three_d)
+            color = np.array([COLOR_INDEX.get(getattr(organism, "color", None), 0) for organism in organisms],
+                             dtype=np.int8)
+        if isinstance(world.food, FoodField):
+            food_ids = world.food.ripe
+            food_position = np.zeros((0, 3), dtype=np.float32)
+        else:
+            food_ids = self.ids(world.food, numbering)
+            food_position = positions(world.food, three_d)
+        self.numbering = numbering
+
+        order = np.argsort(ids, kind="stable")
+        food_order = np.argsort(food_ids, kind="stable")
+        if len(food_position):
+            food_position = food_position[food_order]
+        return {"organism.id": ids[order], "organism.position": position[order], "organism.color": color[order],
+                "food.id": food_ids[food_order], "food.position": food_position}
+
+    def capture(self):
+        state = self.state()
+        fights = np.array(self.fights, dtype=np.float32).reshape(-1, 3)
+        self.fights = []
+        tick = self.world.ticks
+        if self.previous is None or (tick - self.first_tick) % self.keyframe_every == 0:
+            columns = dict(state, **{"fight.position": fights})
+            self.write(tick, KEYFRAME, {}, columns)
+        else:
+            self.write(tick, DELTA, {}, self.delta(self.previous, state, fights))
+        self.previous = state
+
+    def delta(self, before, after, fights):
+        ids, old_ids = after["organism.id"], before["organism.id"]
+        position = after["organism.position"]
+        # Row of each organism in the previous state, where it has one
+        index = np.minimum(np.searchsorted(old_ids, ids), max(len(old_ids) - 1, 0))
+        known = old_ids[index] == ids if len(old_ids) else np.zeros(len(ids), dtype=bool)
+        moved = known.copy()
+        moved[known] = np.any(before["organism.position"][index[known]] != position[known], axis=1)
+        food, old_food = after["food.id"], before["food.id"]
+        added = ~np.isin(food, old_food)
+        food_position = after["food.position"]
+        return {
+            "born.id": ids[~known], "born.position": position[~known], "born.color": after["organism.color"][~known],
+            "moved.id": ids[moved], "moved.position": position[moved],
+            "died.id": old_ids[~np.isin(old_ids, ids)],
+            "food_added.id": food[added],
+            "food_added.position": food_position[added] if len(food_position) else food_position,
+            "food_removed.id": old_food[~np.isin(old_food, food)],
+            "fight.position": fights,
+        }
+
+    def write(self, tick, kind, meta, columns):
+        typecodes = {np.dtype(np.float32): "f", np.dtype(np.int64): "q", np.dtype(np.int8): "b"}
+        payload = snapshot.pack(meta, {name: (typecodes[values.dtype], np.ascontiguousarray(values))
+                                       for name, values in columns.items()})
+        self.file.write(RECORD.pack(len(payload), tick, kind) + payload)
+
+    def close(self):
+        self.file.close()
+
+
+class ReplayState:
+    # Organisms ({id: [x, y, z, colour]}) and food ({id: (x, y, z) or None
+    # for a food field cell}) at one tick of a replay, plus the ids changed
+    # and fights seen since the last time a player looked at them
+
+    def __init__(self):
+        self.organisms = {}
+        self.food = {}
+        self.changed = set()
+        self.food_changed = set()
+        self.fights = []
+
+    def apply(self, kind, columns):
+        self.fights.extend(columns["fight.position"].reshape(-1, 3).tolist())
+        if kind == KEYFRAME:
+            self.changed.update(self.organisms)
+            self.food_changed.update(self.food)
+            points = columns["organism.position"].reshape(-1, 3).tolist()
+            self.organisms = {i: [*position, color] for i, position, color in
+                              zip(columns["organism.id"].tolist(), points, columns["organism.color"].tolist())}
+            food_positions = columns["food.position"].reshape(-1, 3).tolist() or itertools.repeat(None)
+            self.food = dict(zip(columns["food.id"].tolist(), food_positions))
+            self.changed.update(self.organisms)
+            self.food_changed.update(self.food)
+            return
+
+        for i, position, color in zip(columns["born.id"].tolist(), columns["born.position"].reshape(-1, 3).tolist(),
+                                      columns["born.color"].tolist()):
+            self.organisms[i] = [*position, color]
+            self.changed.add(i)
+        for i, position in zip(columns["moved.id"].tolist(), columns["moved.position"].reshape(-1, 3).tolist()):
+            self.organisms[i][:3] = position
+            self.changed.add(i)
+        for i in columns["died.id"].tolist():
+            del self.organisms[i]
+            self.changed.add(i)
+        food_positions = columns["food_added.position"].reshape(-1, 3).tolist() or itertools.repeat(None)
+        for i, position in zip(columns["food_added.id"].tolist(), food_positions):
+            self.food[i] = position
+            self.food_changed.add(i)
+        for i in columns["food_removed.id"].tolist():
+            del self.food[i]
+            self.food_changed.add(i)
+
+
+class Replay:
+    # Read side of a replay log. Opening it only reads the record headers;
+    # state_at(tick) decodes the keyframe at or before the tick and at most
+    # keyframe_every - 1 deltas after it, whatever the length of the log.
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        if self.file.read(4) != MAGIC:
+            raise ValueError(f"{path} is not a replay log")
+        version, = struct.unpack("<H", self.file.read(2))
+        if version != VERSION:
+            raise ValueError(f"{path} has replay format {version}, expected {VERSION}")
+        self.records = {}
+        self.keyframes = []
+        self.meta = None
+        end = os.fstat(self.file.fileno()).st_size
+        offset = self.file.tell()
+        while offset + RECORD.size <= end:
+            self.file.seek(offset)
+            size, tick, kind = RECORD.unpack(self.file.read(RECORD.size))
+            offset += RECORD.size
+            if offset + size > end:
+                break
+            if kind == HEADER:
+                self.meta, _ = snapshot.unpack(self.file.read(size))
+            else:
+                self.records[tick] = (offset, size, kind)
+                if kind == KEYFRAME:
+                    self.keyframes.append(tick)
+            offset += size
+        if self.meta is None or not self.keyframes:
+            raise ValueError(f"{path} holds no recorded ticks")
+        self.first_tick = self.keyframes[0]
+        self.last_tick = max(self.records)
+
+    def record(self, tick):
+        offset, size, kind = self.records[tick]
+        self.file.seek(offset)
+        _, columns = snapshot.unpack(self.file.read(size))
+        return kind, {name: np.frombuffer(values, dtype=values.typecode) for name, values in columns.items()}
+
+    def state_at(self, tick, state=None):
+        tick = min(max(tick, self.first_tick), self.last_tick)
+        keyframe = self.keyframes[bisect.bisect_right(self.keyframes, tick) - 1]
+        state = state if state is not None else ReplayState()
+        for t in range(keyframe, tick + 1):
+            if t == tick:
+                # Only the fights of the tick sought to are shown
+                state.fights = []
+            state.apply(*self.record(t))
+        return state
+
+    def close(self):
+        self.file.close()
+
+
+class ReplayEntity:
+    # What a renderer is handed in place of an Organism or Food
+    __slots__ = ("x", "y", "z", "color")
+
+    def __init__(self, x, y, z, color):
+        self.x, self.y, self.z, self.color = x, y, z, color
+
+
+class Player:
+    # Plays a replay into a renderer on a fixed-timestep clock like a live
+    # world: one replayed tick per `timestep` of the recorded world, `speed`
+    # times faster than real time. Ticks are applied to a ReplayState and the
+    # renderer only hears about what changed once per drawn frame, so fast
+    # playback costs no more renderer calls than slow playback.
+
+    def __init__(self, replay, renderer, speed=10.0, frame_rate=30, start=None):
+        self.replay = replay
+        self.renderer = renderer
+        self.state = ReplayState()
+        self.shown = {}
+        self.food_shown = {}
+        meta = replay.meta
+        field = meta["food_field"]
+        # Food field cells are shown as either empty or ripe
+        self.food = None
+        if field is not None:
+            self.food = FoodField(meta["width"], meta["height"], meta["depth"], field["cell_size"],
+                                  minimum=field["minimum"])
+        self.paused = False
+        self.ticks = replay.first_tick
+        self.scheduler = Scheduler(replay.meta["timestep"], frame_rate, speed, max_steps_per_frame=10 ** 6)
+        self.scheduler.every(replay.meta["timestep"], self.step)
+        self.seek(replay.first_tick if start is None else start)
+
+    def step(self):
+        if self.paused or self.ticks >= self.replay.last_tick:
+            return
+        self.ticks += 1
+        self.state.apply(*self.replay.record(self.ticks))
+
+    def seek(self, tick):
+        # Everything shown is compared with the state at the new tick, so the
+        # renderer only gets the difference
+        state = self.replay.state_at(tick)
+        state.changed = set(self.shown) | set(state.organisms)
+        state.food_changed = set(self.food_shown) | set(state.food) | set(self.state.food)
+        self.state = state
+        self.ticks = min(max(tick, self.replay.first_tick), self.replay.last_tick)
+        self.sync()
+
+    def sync(self):
+        state, renderer = self.state, self.renderer
+        for i in state.changed:
+            values = state.organisms.get(i)
+            entity = self.shown.get(i)
+            if values is None:
+                if entity is not None:
+                    renderer.remove(self.shown.pop(i))
+            elif entity is None:
+                self.shown[i] = entity = ReplayEntity(values[0], values[1], values[2], COLORS[values[3]])
+                renderer.add_organism(entity)
+            else:
+                entity.x, entity.y, entity.z = values[:3]
+                renderer.move(entity)
+        if self.food is not None:
+            ids = np.fromiter(state.food_changed, dtype=np.int64)
+            self.food.set(self.food.cells(ids), [self.food.minimum if i in state.food else 0 for i in ids.tolist()])
+        else:
+            for i in state.food_changed:
+                position = state.food.get(i)
+                if position is None:
+                    if i in self.food_shown:
+                        renderer.remove(self.food_shown.pop(i))
+                elif i not in self.food_shown:
+                    self.food_shown[i] = entity = ReplayEntity(*position, None)
+                    renderer.add_food(entity)
+        for x, y, z in state.fights:
+            renderer.mark_fight(x, y, z)
+        state.changed = set()
+        state.food_changed = set()
+        state.fights = []
+
+    def frame(self):
+        # Returns whether the frame was drawn
+        if not self.scheduler.advance():
+            return False
+        self.sync()
+        self.renderer.draw(self)
+        return True
+
+
+def view_tk(replay, speed, frame_rate, start, raster=False):
+    import tkinter as tk
+    from render_tk import TkRasterRenderer, TkRenderer
+
+    root = tk.Tk()
+    root.title("Genezis replay")
+    canvas = tk.Canvas(root, width=replay.meta["width"], height=replay.meta["height"])
+    canvas.pack()
+    player = Player(replay, (TkRasterRenderer if raster else TkRenderer)(canvas), speed, frame_rate, start)
+    jump = replay.meta["keyframe_every"]
+    root.bind("<Left>", lambda event: player.seek(player.ticks - jump))
+    root.bind("<Right>", lambda event: player.seek(player.ticks + jump))
+    root.bind("<space>", lambda event: setattr(player, "paused", not player.paused))
+
+    def frame():
+        if player.frame():
+            root.title(f"Genezis replay - tick {player.ticks}")
+        root.after(max(1, int(1000 * player.scheduler.frame_delay())), frame)
+
+    frame()
+    root.mainloop()
+
+
+def view_vpython(replay, speed, frame_rate, start):
+    from vpython import rate, slider, wtext
+    from render_vpython import VPythonLODRenderer
+
+    renderer = VPythonLODRenderer()
+    player = Player(replay, renderer, speed, frame_rate, start)
+    renderer.scene.append_to_caption("\n")
+    bar = slider(min=replay.first_tick, max=replay.last_tick, value=player.ticks, length=800,
+                 bind=lambda bar: player.seek(int(bar.value)))
+    caption = wtext(text="")
+    while True:
+        rate(frame_rate)
+        if player.frame():
+            bar.value = player.ticks
+            caption.text = f" tick {player.ticks}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="replay", description="Play back a world recorded with genezis run --record")
+    parser.add_argument("path")
+    parser.add_argument("--start", type=int, help="tick to start from")
+    parser.add_argument("--speed", type=float, default=10.0, help="times faster than the recorded world ran")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--raster", action="store_true", help="2D: draw each frame as one image")
+    args = parser.parse_args(argv)
+
+    replay = Replay(args.path)
+    if replay.meta["depth"] is None:
+        view_tk(replay, args.speed, args.fps, args.start, args.raster)
+    else:
+        view_vpython(replay, args.speed, args.fps, args.start)
+
+
+if __name__ == "__main__":
+    main()
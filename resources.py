@@ -0,0 +1,156 @@
+import math
+
+import numpy as np
+
+from spatial import nearest_within
+
+
+class FoodField:
+    # Food as an amount per cell of a regular grid over the world instead of
+    # one object per item. Every regrow() sprouts `regrowth` = (fewest, most)
+    # random cells by a random `portion` each, up to `capacity` per cell, so
+    # the food a world gets per step does not depend on its size: the
+    # defaults match the 5 to 20 items worth 50 to 100 the worlds spawned
+    # before. Organisms see a cell as food once it holds `minimum` and eat all
+    # of it at once. The cells holding food are kept in a sorted index that
+    # is updated as cells change, so len() and lookups never scan the whole
+    # grid. A field may cover only the block of cells low <= cell < high (a
+    # tile and its margin); cells are always given in world coordinates.
+
+    def __init__(self, width, height, depth, cell_size=10, capacity=100, regrowth=(5, 20), portion=(50, 100),
+                 minimum=50, rng=None, low=(0, 0, 0), high=None):
+        self.cell_size = cell_size
+        self.capacity = capacity
+        self.regrowth = regrowth
+        self.portion = portion
+        self.minimum = minimum
+        # A numpy Generator; only a field that regrows needs one
+        self.rng = rng
+        self.shape = tuple(math.ceil(side / cell_size) for side in (width, height, depth))
+        self.low = np.array(low, dtype=np.int64)
+        self.high = np.array(self.shape if high is None else high, dtype=np.int64)
+        self.amount = np.zeros(tuple(self.high - self.low), dtype=np.float32)
+        # Flat indices into amount of the cells holding food, in order
+        self.ripe = np.zeros(0, dtype=np.int64)
+        if rng is not None:
+            # One step's worth to start with, like the first spawn of the old worlds
+            self.regrow()
+
+    def cell(self, x, y, z):
+        return int(x // self.cell_size), int(y // self.cell_size), int(z // self.cell_size)
+
+    def centre(self, cell):
+        return tuple((c + 0.5) * self.cell_size for c in cell)
+
+    def centres(self, cells):
+        return (cells + 0.5) * self.cell_size
+
+    def cells(self, flat):
+        # Cells of flat indices into amount
+        return np.stack(np.unravel_index(flat, self.amount.shape), axis=-1).reshape(-1, 3) + self.low
+
+    def index(self, cells):
+        # Flat indices into amount of the cells of an (n, 3) array the field
+        # covers, and which of them it covers
+        cells = np.asarray(cells, dtype=np.int64).reshape(-1, 3) - self.low
+        inside = np.all((cells >= 0) & (cells < self.amount.shape), axis=1)
+        return np.ravel_multi_index(tuple(cells[inside].T), self.amount.shape), inside
+
+    def reindex(self, flat):
+        # Brings the ripe index up to date after the cells at flat changed
+        flat = np.unique(flat)
+        at = np.minimum(np.searchsorted(self.ripe, flat), max(len(self.ripe) - 1, 0))
+        was = self.ripe[at] == flat if len(self.ripe) else np.zeros(len(flat), dtype=bool)
+        now = self.amount.reshape(-1)[flat] >= self.minimum
+        if np.any(was & ~now):
+            self.ripe = np.delete(self.ripe, at[was & ~now])
+        if np.any(now & ~was):
+            added = flat[now & ~was]
+            self.ripe = np.insert(self.ripe, np.searchsorted(self.ripe, added), added)
+
+    def regrow(self):
+        # Sprouts the cells of one step and returns them
+        count = self.rng.integers(self.regrowth[0], self.regrowth[1] + 1)
+        cells = self.rng.integers(0, self.shape, size=(count, 3))
+        portions = self.rng.integers(self.portion[0], self.portion[1] + 1, size=count)
+        flat, inside = self.index(cells)
+        amount = self.amount.reshape(-1)
+        np.add.at(amount, flat, portions[inside])
+        amount[flat] = np.minimum(amount[flat], self.capacity)
+        self.reindex(flat)
+        return cells
+
+    def get(self, cells):
+        flat, _ = self.index(cells)
+        return self.amount.reshape(-1)[flat]
+
+    def set(self, cells, values):
+        # Sets the cells of an (n, 3) array to values, the last of repeated
+        # cells winning; cells the field doesn't cover are left out
+        flat, inside = self.index(cells)
+        self.amount.reshape(-1)[flat] = np.broadcast_to(values, inside.shape)[inside]
+        self.reindex(flat)
+
+    def fill(self, cells):
+        # Tops the cells of an (n, 3) array of indices up to capacity
+        self.set(cells, self.capacity)
+
+    def restore(self, amount):
+        # All amounts at once, as loaded from a snapshot
+        self.amount[...] = amount
+        self.ripe = np.flatnonzero(self.amount >= self.minimum)
+
+    def block(self, low, high):
+        # Copy of the amounts of the cells low <= cell < high
+        low, high = np.asarray(low) - self.low, np.asarray(high) - self.low
+        return self.amount[low[0]:high[0], low[1]:high[1], low[2]:high[2]].copy()
+
+    def take(self, cell):
+        # Everything in the cell, or nothing if it is not ripe (already eaten)
+        flat, _ = self.index(cell)
+        value = float(self.amount.reshape(-1)[flat[0]])
+        if value < self.minimum:
+            return 0.0
+        self.amount.reshape(-1)[flat] = 0
+        self.reindex(flat)
+        return value
+
+    def take_many(self, cells):
+        # Everything in each of an (n, 3) array of different ripe cells
+        flat, _ = self.index(cells)
+        amount = self.amount.reshape(-1)
+        values = amount[flat]
+        amount[flat] = 0
+        self.reindex(flat)
+        return values
+
+    def nearest(self, position, radius):
+        # Closest cell holding food whose centre is within radius, or None
+        size = self.cell_size
+        origin = self.low.tolist()
+        low = [max(0, int((c - radius) // size) - o) for c, o in zip(position, origin)]
+        high = [min(n, int((c + radius) // size) + 1 - o) for c, o, n in zip(position, origin, self.amount.shape)]
+        block = self.amount[low[0]:high[0], low[1]:high[1], low[2]:high[2]]
+        cells = np.argwhere(block >= self.minimum)
+        if not len(cells):
+            return None
+        cells += self.low + low
+        distance2 = (((cells + 0.5) * size - position) ** 2).sum(axis=1)
+        best = distance2.argmin()
+        if distance2[best] > radius * radius:
+            return None
+        return tuple(cells[best].tolist())
+
+    def nearest_many(self, positions, radius):
+        # nearest() for every row of positions at once: the cell of and the
+        # distance to the closest cell holding food within radius, -1 / inf
+        # where there is none. Only the ripe index is searched, and as it is in
+        # index order the first of equally near cells wins, as in nearest().
+        if not len(self.ripe):
+            return np.full((len(positions), 3), -1, dtype=np.int64), np.full(len(positions), np.inf)
+        cells = self.cells(self.ripe)
+        found, distance = nearest_within(positions, radius, self.centres(cells))
+        return np.where(found[:, None] >= 0, cells[found], -1), distance
+
+    def __len__(self):
+        return len(self.ripe)
@@ -0,0 +1,76 @@
+import time
+
+
+class Scheduler:
+    # Fixed-timestep clock of a world. Simulated time only ever advances in
+    # steps of `timestep` seconds, and each step runs the jobs that are due,
+    # in the order they were registered: the world's own update and periodic
+    # systems such as food spawning. A headless run just calls step(); a
+    # front-end calls advance() once per frame, which runs as many steps as
+    # the real time since the last frame is worth and says whether to draw.
+
+    def __init__(self, timestep=0.1, frame_rate=30, speed=1.0, max_steps_per_frame=10, max_frame_skip=5,
+                 clock=time.perf_counter):
+        self.timestep = timestep
+        self.frame_rate = frame_rate
+        # Simulated seconds per real second; None steps as fast as the frames allow
+        self.speed = speed
+        self.max_steps_per_frame = max_steps_per_frame
+        self.max_frame_skip = max_frame_skip
+        self.clock = clock
+        self.jobs = []
+        self.steps = 0
+        self.lag = 0.0
+        self.last_frame = None
+        self.skipped_frames = 0
+
+    def every(self, seconds, function):
+        # Runs function on every step whose start is a multiple of `seconds`
+        # of simulated time (rounded to whole steps)
+        self.jobs.append((max(1, round(seconds / self.timestep)), function))
+        return function
+
+    @property
+    def time(self):
+        return self.steps * self.timestep
+
+    def step(self):
+        for period, function in self.jobs:
+            if self.steps % period == 0:
+                function()
+        self.steps += 1
+
+    def advance(self):
+        now = self.clock()
+        elapsed = 0.0 if self.last_frame is None else now - self.last_frame
+        self.last_frame = now
+        frame_time = 1 / self.frame_rate
+
+        if self.speed is None:
+            # Nothing to wait for: fill the frame with steps
+            self.step()
+            while self.clock() - now < frame_time:
+                self.step()
+            return True
+
+        self.lag += elapsed * self.speed
+        steps = 0
+        while self.lag >= self.timestep and steps < self.max_steps_per_frame:
+            self.step()
+            self.lag -= self.timestep
+            steps += 1
+        # Still behind after max_steps_per_frame: let the simulation run slow
+        # instead of trying to catch up forever
+        self.lag = min(self.lag, self.timestep)
+
+        # While the steps alone take longer than a frame, skip drawing, but
+        # never more than max_frame_skip frames in a row
+        if self.clock() - now > frame_time and self.skipped_frames < self.max_frame_skip:
+            self.skipped_frames += 1
+            return False
+        self.skipped_frames = 0
+        return True
+
+    def frame_delay(self):
+        # Seconds until the next frame is due
+        return max(0.0, self.last_frame + 1 / self.frame_rate - self.clock())
@@ -0,0 +1,89 @@
+import itertools
+import json
+import struct
+import zlib
+from array import array
+
+# File layout: MAGIC, format version, then one zlib stream holding the length
+# of a JSON header, the header and the raw bytes of every column in header
+# order. Columns are flat arrays of one machine type ('d', 'q' or 'b'), so
+# loading them is a memcpy instead of per-object parsing, and no pickle is
+# involved.
+MAGIC = b"GNZS"
+VERSION = 4
+
+
+def pack(meta, columns):
+    # columns: {name: (typecode, values)}; values is a list, array.array or
+    # numpy array already of the matching type. Returns the compressed body.
+    layout = []
+    blobs = []
+    for name, (typecode, values) in columns.items():
+        data = values.tobytes() if hasattr(values, "tobytes") else array(typecode, values).tobytes()
+        layout.append([name, typecode, len(data)])
+        blobs.append(data)
+    header = json.dumps({"meta": meta, "columns": layout}).encode()
+    return zlib.compress(struct.pack("<I", len(header)) + header + b"".join(blobs), 1)
+
+
+def unpack(data):
+    body = zlib.decompress(data)
+    header_size, = struct.unpack_from("<I", body)
+    header = json.loads(body[4:4 + header_size])
+    columns = {}
+    offset = 4 + header_size
+    for name, typecode, size in header["columns"]:
+        column = array(typecode)
+        column.frombytes(body[offset:offset + size])
+        columns[name] = column
+        offset += size
+    return header["meta"], columns
+
+
+def dump(path, meta, columns):
+    body = pack(meta, columns)
+    with open(path, "wb") as f:
+        f.write(MAGIC + struct.pack("<H", VERSION) + body)
+
+
+def load(path, engine):
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != MAGIC:
+        raise ValueError(f"{path} is not a world snapshot")
+    version, = struct.unpack_from("<H", data, 4)
+    if version != VERSION:
+        raise ValueError(f"{path} has snapshot format {version}, expected {VERSION}")
+
+    meta, columns = unpack(data[6:])
+    if meta["engine"] != engine:
+        raise ValueError(f"{path} is a snapshot of a {meta['engine']} world, not {engine}")
+    return meta, columns
+
+
+def entity_columns(prefix, entities, fields):
+    # One column per attribute, e.g. "organism.energy"
+    return {prefix + name: (typecode, [getattr(entity, name) for entity in entities])
+            for name, typecode in fields.items()}
+
+
+def restore_entities(cls, prefix, columns, fields, count, **shared):
+    # Rebuilds objects straight from their columns, without running __init__
+    values = [columns[prefix + name].tolist() for name in fields]
+    entities = []
+    for row in zip(*values) if values else [()] * count:
+        entity = cls.__new__(cls)
+        for name, value in itertools.chain(shared.items(), zip(fields, row)):
+            setattr(entity, name, value)
+        entities.append(entity)
+    return entities
+
+
+def index_order(index, numbering):
+    # Insertion order of a SpatialHash, so cell lists come back in the same order
+    return [numbering[entity] for entity in index.cell_of_entity]
+
+
+def set_random_state(rng, state):
+    version, internal, gauss_next = state
+    rng.setstate((version, tuple(internal), gauss_next))
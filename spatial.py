@@ -0,0 +1,265 @@
+import heapq
+import itertools
+import math
+from operator import itemgetter
+
+import numpy as np
+
+# Targets per bucket nearest_within aims for when the targets are dense
+BUCKET_TARGETS = 4
+
+
+class SpatialHash:
+    # Sparse replacement for a dense world grid: only cells that hold something
+    # are stored, keyed by the tuple of cell_size buckets of a position. It is
+    # updated in place as entities move, so nothing is rebuilt per tick and
+    # memory follows the number of entities instead of the world volume.
+    # With a cell_size close to the typical query radius it also answers the
+    # radius and nearest-neighbour queries organisms use to look around.
+
+    def __init__(self, cell_size=1):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.cell_of_entity = {}
+        self.position_of_entity = {}
+
+    def cell(self, *position):
+        return tuple(int(c // self.cell_size) for c in position)
+
+    def insert(self, entity, *position):
+        cell = self.cell(*position)
+        self.cells.setdefault(cell, []).append(entity)
+        self.cell_of_entity[entity] = cell
+        self.position_of_entity[entity] = position
+        return cell
+
+    def remove(self, entity):
+        cell = self.cell_of_entity.pop(entity, None)
+        if cell is not None:
+            del self.position_of_entity[entity]
+            items = self.cells[cell]
+            items.remove(entity)
+            if not items:
+                del self.cells[cell]
+        return cell
+
+    def move(self, entity, *position):
+        cell = self.cell(*position)
+        if self.cell_of_entity.get(entity) != cell:
+            self.remove(entity)
+            self.cells.setdefault(cell, []).append(entity)
+            self.cell_of_entity[entity] = cell
+        self.position_of_entity[entity] = position
+        return cell
+
+    def items_at(self, *position):
+        return self.cells.get(self.cell(*position), ())
+
+    def is_occupied(self, *position, ignore=None):
+        items = self.cells.get(self.cell(*position))
+        if not items:
+            return False
+        return ignore is None or any(item is not ignore for item in items)
+
+    def within(self, position, radius, accept=None):
+        # (distance, entity) pairs for everything within radius of position
+        low = self.cell(*(c - radius for c in position))
+        high = self.cell(*(c + radius for c in position))
+        volume = math.prod(h - l + 1 for l, h in zip(low, high))
+        if volume <= len(self.cells):
+            cells = itertools.product(*(range(l, h + 1) for l, h in zip(low, high)))
+            buckets = (self.cells.get(cell) for cell in cells)
+        else:
+            # The query box is larger than the populated part of the world
+            buckets = (items for cell, items in self.cells.items()
+                       if all(l <= c <= h for c, l, h in zip(cell, low, high)))
+
+        found = []
+        radius2 = radius * radius
+        for items in buckets:
+            if items:
+                for entity in items:
+                    d2 = sum((a - b) ** 2 for a, b in zip(self.position_of_entity[entity], position))
+                    if d2 <= radius2 and (accept is None or accept(entity)):
+                        found.append((math.sqrt(d2), entity))
+        return found
+
+    def nearest(self, position, radius, accept=None):
+        found = self.within(position, radius, accept)
+        return min(found, key=itemgetter(0))[1] if found else None
+
+    def k_nearest(self, position, radius, k, accept=None):
+        return [entity for _, entity in heapq.nsmallest(k, self.within(position, radius, accept), key=itemgetter(0))]
+
+    def clear(self):
+        self.cells.clear()
+        self.cell_of_entity.clear()
+        self.position_of_entity.clear()
+
+    def __contains__(self, entity):
+        return entity in self.cell_of_entity
+
+    def __len__(self):
+        return len(self.cell_of_entity)
+
+
+class SphereWatch:
+    # Spheres that want to hear when something enters them, such as sleeping
+    # organisms waiting for anything to come into sight. A sphere is listed
+    # in every cell its bounding box overlaps, so entered() only measures the
+    # spheres listed in the one cell of the position it is given.
+
+    def __init__(self, cell_size=32):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.spheres = {}
+
+    def cell(self, *position):
+        return tuple(int(c // self.cell_size) for c in position)
+
+    def add(self, watcher, centre, radius):
+        low = self.cell(*(c - radius for c in centre))
+        high = self.cell(*(c + radius for c in centre))
+        cells = list(itertools.product(*(range(l, h + 1) for l, h in zip(low, high))))
+        for cell in cells:
+            self.cells.setdefault(cell, {})[watcher] = None
+        self.spheres[watcher] = (centre, radius * radius, cells)
+
+    def remove(self, watcher):
+        entry = self.spheres.pop(watcher, None)
+        if entry is not None:
+            for cell in entry[2]:
+                watchers = self.cells[cell]
+                del watchers[watcher]
+                if not watchers:
+                    del self.cells[cell]
+
+    def entered(self, *position):
+        # Every watcher whose sphere contains position
+        watchers = self.cells.get(self.cell(*position))
+        if not watchers:
+            return []
+        found = []
+        for watcher in watchers:
+            centre, radius2, _ = self.spheres[watcher]
+            if sum((a - b) ** 2 for a, b in zip(centre, position)) <= radius2:
+                found.append(watcher)
+        return found
+
+    def clear(self):
+        self.cells.clear()
+        self.spheres.clear()
+
+    def __contains__(self, watcher):
+        return watcher in self.spheres
+
+    def __len__(self):
+        return len(self.spheres)
+
+
+def bucket_offsets(rings):
+    # Bucket offsets within `rings` buckets along each axis, nearest first,
+    # with the squared distance (in buckets) to the nearest point of each
+    grid = np.arange(-rings, rings + 1)
+    offsets = np.stack(np.meshgrid(grid, grid, grid, indexing="ij"), axis=-1).reshape(-1, 3)
+    bound2 = (np.maximum(np.abs(offsets) - 1, 0) ** 2).sum(axis=1)
+    order = np.lexsort((np.abs(offsets).sum(axis=1), bound2))
+    return offsets[order], bound2[order]
+
+
+def nearest_within(points, radius, targets, accept=None):
+    # Index of and distance to the nearest target within radius of each point,
+    # -1 / inf where there is none. Of equally near targets the lowest index
+    # wins, so the result does not depend on how the targets are bucketed.
+    # Targets are sorted into cubic buckets of about BUCKET_TARGETS targets,
+    # rounded up so that the largest radius spans one to four buckets, and
+    # each point visits the buckets around its own nearest first. A bucket is
+    # skipped when it is farther than the point's radius or best match so far,
+    # and a point stops once every bucket left is; all targets of the buckets
+    # visited in one step are compared at once.
+    best = np.full(len(points), -1, dtype=np.intp)
+    best_d2 = np.full(len(points), np.inf)
+    if len(points) == 0 or len(targets) == 0:
+        return best, np.sqrt(best_d2)
+
+    reach = max(float(radius.max()), 1.0)
+    low = targets.min(axis=0)
+    volume = float(np.prod(np.maximum(targets.max(axis=0) - low, 1.0)))
+    rings = int(min(max(reach // np.cbrt(volume / len(targets) * BUCKET_TARGETS), 1), 4))
+    size = reach / rings
+    target_cells = np.floor((targets - low) / size).astype(np.int64)
+    dims = target_cells.max(axis=0) + 1
+    keys = np.ravel_multi_index(target_cells.T, dims)
+    order = np.argsort(keys, kind="stable")
+    bucket_keys, bucket_start, bucket_count = np.unique(keys[order], return_index=True, return_counts=True)
+
+    strides = np.array([dims[1] * dims[2], dims[2], 1])
+    # Rows of the points still looking: their index, radius, best match so
+    # far, bucket key, and the squared distance to the near side of the
+    # bucket d steps away along each axis with whether that bucket exists
+    looking = np.arange(len(points))
+    radius2 = radius ** 2
+    found = best.copy()
+    found_d2 = best_d2.copy()
+    point_cells = np.floor((points - low) / size).astype(np.int64)
+    point_keys = point_cells @ strides
+    steps = np.arange(-rings, rings + 1)[:, None, None]
+    inner = (points - low - point_cells * size).T
+    axis_gap2 = np.where(steps < 0, inner + (-steps - 1) * size,
+                         np.where(steps > 0, size - inner + (steps - 1) * size, 0.0)) ** 2
+    axis_inside = (point_cells.T + steps >= 0) & (point_cells.T + steps < dims[:, None])
+
+    offsets, bound2 = bucket_offsets(rings)
+    for offset, bound in zip(offsets, bound2 * size * size):
+        limit = np.minimum(radius2, found_d2)
+        if bound:
+            still = limit >= bound
+            count = np.count_nonzero(still)
+            if count < len(still) // 2:
+                # Points whose radius and best match are nearer than every bucket left are done
+                best[looking], best_d2[looking] = found, found_d2
+                if not count:
+                    break
+                looking, radius2, found, found_d2, limit = (looking[still], radius2[still], found[still],
+                                                             found_d2[still], limit[still])
+                point_keys = point_keys[still]
+                axis_gap2, axis_inside = axis_gap2[:, :, still], axis_inside[:, :, still]
+        dx, dy, dz = offset + rings
+        near = axis_inside[dx, 0] & axis_inside[dy, 1] & axis_inside[dz, 2]
+        near &= axis_gap2[dx, 0] + axis_gap2[dy, 1] + axis_gap2[dz, 2] <= limit
+        query = np.flatnonzero(near)
+        if not query.size:
+            continue
+        key = point_keys[query] + offset @ strides
+        slot = np.minimum(np.searchsorted(bucket_keys, key), len(bucket_keys) - 1)
+        hit = bucket_keys[slot] == key
+        query, slot = query[hit], slot[hit]
+        if not query.size:
+            continue
+
+        # Every (point, target) pair of the visited buckets, grouped by point
+        count = bucket_count[slot]
+        owner = np.repeat(query, count)
+        first = np.repeat(bucket_start[slot] - np.cumsum(count) + count, count)
+        target = order[first + np.arange(len(owner))]
+        d2 = ((targets[target] - points[looking[owner]]) ** 2).sum(axis=1)
+        keep = d2 <= radius2[owner]
+        if accept is not None:
+            keep &= accept(looking[owner], target)
+        owner, target, d2 = owner[keep], target[keep], d2[keep]
+        if not owner.size:
+            continue
+
+        # Nearest target of each point, the lowest index among equally near ones
+        starts = np.flatnonzero(np.concatenate([[True], owner[1:] != owner[:-1]]))
+        nearest = np.minimum.reduceat(d2, starts)
+        tied = d2 == np.repeat(nearest, np.diff(np.append(starts, len(owner))))
+        lowest = np.minimum.reduceat(np.where(tied, target, len(targets)), starts)
+        owner = owner[starts]
+        better = (nearest < found_d2[owner]) | ((nearest == found_d2[owner]) & (lowest < found[owner]))
+        found[owner[better]] = lowest[better]
+        found_d2[owner[better]] = nearest[better]
+    else:
+        best[looking], best_d2[looking] = found, found_d2
+
+    return best, np.sqrt(best_d2)
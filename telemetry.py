@@ -0,0 +1,66 @@
+import csv
+import os
+from collections import Counter, deque
+
+# Verbosity levels: QUIET prints nothing, TICKS prints one line of counters
+# per tick, EVENTS also prints every recorded event.
+QUIET, TICKS, EVENTS = 0, 1, 2
+
+EVENT_FIELDS = ["tick", "kind", "national_id", "color", "detail"]
+
+
+class Telemetry:
+    # Replaces per-tick print(): the last `capacity` tick counters and events
+    # are kept in ring buffers for live inspection, and when a path is given
+    # everything is appended to <path>.ticks.csv / <path>.events.csv in batches
+    # every `flush_every` ticks.
+
+    def __init__(self, verbosity=QUIET, capacity=10000, path=None, flush_every=100):
+        self.verbosity = verbosity
+        self.tick_rows = deque(maxlen=capacity)
+        self.event_rows = deque(maxlen=capacity)
+        self.path = path
+        self.flush_every = flush_every
+        self.unflushed_ticks = []
+        self.unflushed_events = []
+
+    def tick(self, tick, **counters):
+        row = dict(tick=tick, **counters)
+        self.tick_rows.append(row)
+        if self.verbosity >= TICKS:
+            print(", ".join(f"{name}: {value}" for name, value in row.items()))
+        if self.path:
+            self.unflushed_ticks.append(row)
+            if tick % self.flush_every == 0:
+                self.flush()
+
+    def event(self, tick, kind, national_id=None, color=None, detail=None):
+        row = (tick, kind, national_id, color, detail)
+        self.event_rows.append(row)
+        if self.verbosity >= EVENTS:
+            print(" ".join(str(value) for value in row if value is not None))
+        if self.path:
+            self.unflushed_events.append(row)
+
+    def event_counts(self, kind=None):
+        # Events still in the buffer per (kind, national_id, color)
+        return Counter((row[1], row[2], row[3]) for row in self.event_rows if kind is None or row[1] == kind)
+
+    def flush(self):
+        if not self.path:
+            return
+        if self.unflushed_ticks:
+            self._append(self.path + ".ticks.csv", list(self.unflushed_ticks[0]),
+                         [list(row.values()) for row in self.unflushed_ticks])
+            self.unflushed_ticks = []
+        if self.unflushed_events:
+            self._append(self.path + ".events.csv", EVENT_FIELDS, self.unflushed_events)
+            self.unflushed_events = []
+
+    def _append(self, path, header, rows):
+        new_file = not os.path.exists(path)
+        with open(path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(header)
+            writer.writerows(rows)
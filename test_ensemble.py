@@ -0,0 +1,13 @@
+from ensemble import make_world, run_one, world_kwargs
+
+
+def test_3d_extinction_is_the_tick_the_last_organism_died():
+    # Without food everything starves; a run that ends on that tick sees it too
+    params = {"food_regrowth": [0, 0], "initial_organisms": 10}
+    world, step = make_world("3d", 1, world_kwargs(params))
+    while world.organisms:
+        step()
+    last = world.ticks - 1
+    row = run_one("3d", params, 1, last + 1)
+    assert row["population"] == 0
+    assert row["extinct_tick"] == last
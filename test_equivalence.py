@@ -0,0 +1,61 @@
+from collections import Counter
+
+import numpy as np
+
+from ensemble import COUNTERS
+from genezis_3D import GameWorld
+from population import VectorGameWorld
+from telemetry import Telemetry
+from tiles import TiledWorld
+
+
+def test_tiled_world_matches_one_process():
+    # Same seed, same organisms, food, counters and events every tick,
+    # whatever the split. The tiles are 300 wide and the ghost margin at
+    # most 3 * 25, so organisms really cross and see across tile borders.
+    def config():
+        return dict(seed=7, width=600, height=600, depth=200, initial_organisms=3000,
+                    trait_ranges={"radius_of_sight": [10, 25]}, telemetry=Telemetry(capacity=None))
+
+    single = VectorGameWorld(**config())
+    tiled = TiledWorld((2, 2, 1), world=VectorGameWorld(**config()))
+    try:
+        migrated = 0
+        for tick in range(100):
+            single.tick()
+            tiled.tick()
+            assert 3 * tiled.sight < 300
+            migrated += sum(len(migrants["uid"]) for migrants in tiled.migrants)
+            expected, got = single.organisms, tiled.organisms
+            assert np.array_equal(expected.uid, got.uid), tick
+            assert np.array_equal(expected.position, got.position), tick
+            assert np.array_equal(expected.energy, got.energy), tick
+            assert np.array_equal(single.food.amount, tiled.food.amount), tick
+            for counter in COUNTERS:
+                assert getattr(single, counter) == getattr(tiled, counter), (tick, counter)
+        assert migrated
+        assert list(single.telemetry.tick_rows) == list(tiled.telemetry.tick_rows)
+        # The tiles report their events one after the other
+        assert Counter(single.telemetry.event_rows) == Counter(tiled.telemetry.event_rows)
+    finally:
+        tiled.close()
+
+
+def test_sleeping_does_not_change_a_3d_run():
+    # Sleepers skip the food search only while it could not find anything
+    def run(sleep_margin):
+        world = GameWorld(seed=5, width=200, height=200, depth=200, initial_organisms=60, sleep_margin=sleep_margin)
+        ticks, slept = [], 0
+        for _ in range(100):
+            world.scheduler.step()
+            slept = max(slept, sum(organism.sleep is not None for organism in world.organisms))
+            ticks.append(([(organism.national_id, organism.x, organism.y, organism.z, organism.energy)
+                           for organism in world.organisms], world.food.amount.copy()))
+        return ticks, slept
+
+    sleeping, slept = run(3)
+    awake, _ = run(None)
+    assert slept
+    for tick, ((organisms, food), (expected, expected_food)) in enumerate(zip(sleeping, awake)):
+        assert organisms == expected, tick
+        assert np.array_equal(food, expected_food), tick
@@ -0,0 +1,14 @@
+from population import VectorGameWorld
+from telemetry import Telemetry
+
+
+def test_every_attack_death_has_one_killer():
+    # An organism killed both as a target and by a strike back is credited once
+    for seed in range(3):
+        world = VectorGameWorld(seed=seed, width=200, height=200, depth=200, initial_organisms=1000,
+                                telemetry=Telemetry(capacity=None))
+        for _ in range(100):
+            world.tick()
+        kinds = [row[1] for row in world.telemetry.event_rows]
+        attack_deaths = sum(row[1] == "death" and row[4] == "attack" for row in world.telemetry.event_rows)
+        assert kinds.count("kill") == attack_deaths == world.dead_by_attack_count > 0, seed
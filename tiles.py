@@ -0,0 +1,360 @@
+import multiprocessing
+import os
+
+import numpy as np
+
+from population import Population, VectorGameWorld
+from renderer import Renderer
+from resources import FoodField
+from scheduler import Scheduler
+from telemetry import Telemetry
+
+COUNTERS = ["dead_organisms_count", "dead_by_attack_count", "dead_by_age_count", "dead_by_fight_count",
+            "dead_by_starvation_count"]
+
+
+def tile_edges(size, tiles):
+    # Inner boundaries of the tiles along each axis
+    return [np.linspace(0, side, count + 1)[1:-1] for side, count in zip(size, tiles)]
+
+
+def tile_of(position, edges, tiles):
+    # Index of the tile holding each position
+    index = np.zeros(len(position), dtype=np.int64)
+    for axis, (inner, count) in enumerate(zip(edges, tiles)):
+        index = index * count + np.searchsorted(inner, position[:, axis], side="right")
+    return index
+
+
+def tile_box(tile, size, tiles):
+    low, high = [], []
+    for side, count, i in zip(size, tiles, np.unravel_index(tile, tiles)):
+        bounds = np.linspace(0, side, count + 1)
+        low.append(bounds[i])
+        high.append(bounds[i + 1])
+    return np.array(low), np.array(high)
+
+
+def take(population, rows):
+    # Column dict of some rows of a Population
+    return {name: getattr(population, name)[rows] for name in population.arrays}
+
+
+def by_uid(*parts):
+    # One Population of all the given column dicts, sorted by uid
+    columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    order = np.argsort(columns["uid"], kind="stable")
+    population = Population(max(64, len(order)))
+    population.append(**{name: values[order] for name, values in columns.items()})
+    return population
+
+
+class FightLog(Renderer):
+    # Collects the fights of a tile so the coordinator can replay them on its renderer
+    def __init__(self):
+        self.fights = []
+
+    def mark_fight(self, x, y, z=0):
+        self.fights.append((x, y, z))
+
+
+class TileWorld(VectorGameWorld):
+    # One tile of a TiledWorld, run in a worker process. Between ticks it
+    # holds the organisms inside its box; for a tick it adds copies (ghosts)
+    # of every organism within `margin` of the box, runs the normal update on
+    # all of them and keeps only its own results. Three sight radii are enough
+    # for the ghosts: an organism's outcome depends on what it sees, what its
+    # enemies see, and what the enemies of its target see. Of the food it
+    # holds only the cells the ghosts can see; the coordinator regrows it.
+
+    def __init__(self, tile, tiles, key, ticks, food, **config):
+        super().__init__(renderer=FightLog(), telemetry=Telemetry(capacity=None), populate=False, **config)
+        self.tile = tile
+        self.tiles = tiles
+        self.edges = tile_edges(self.size, tiles)
+        self.low, self.high = tile_box(tile, self.size, tiles)
+        self.key = key
+        self.ticks = ticks
+        self.hold(*food)
+        self.sight = 1.0
+        self.margin = 0.0
+        self.ghosts = np.zeros(0, dtype=bool)
+        self.eaten = []
+        self.parents = np.zeros(0, dtype=np.int64)
+
+    def adopt(self, columns):
+        self.organisms = by_uid(take(self.organisms, slice(None)), columns)
+
+    def new_food_field(self):
+        # Empty until hold() gets the tile's block
+        return FoodField(self.width, self.height, self.depth, self.cell_size, self.food_capacity, self.food_regrowth,
+                         high=(0, 0, 0))
+
+    def hold(self, low, amount):
+        # The food of the block of cells from `low` on that the tile and its
+        # ghosts can see, as sent by the coordinator
+        self.food = FoodField(self.width, self.height, self.depth, self.cell_size, self.food_capacity,
+                              self.food_regrowth, low=low, high=np.add(low, amount.shape))
+        self.food.restore(amount)
+
+    def eat(self, eaters, cells):
+        # Ghosts gain the energy, but only this tile's meals count: the tile
+        # that owns a ghost decides whether it really ate
+        own = ~self.ghosts[eaters]
+        self.organisms.energy[eaters[~own]] += self.food.get(cells[~own])
+        self.organisms.energy[eaters[own]] += self.food.take_many(cells[own])
+        self.eaten.append(cells[own])
+
+    def count_kills(self, killed):
+        super().count_kills(killed[~self.ghosts[killed]])
+
+    def record_events(self, kind, rows, detail=None):
+        super().record_events(kind, rows[~self.ghosts[rows]], detail)
+
+    def reproduce(self, parents):
+        parents = parents[~self.ghosts[parents]]
+        self.parents = self.organisms.uid[parents]
+        super().reproduce(parents)
+
+    def new_uids(self, count):
+        # Given out by the coordinator in exchange()
+        return np.full(count, -1)
+
+    def update_counters(self, organisms=None):
+        pass
+
+    def step(self, changes, food, ghosts, migrants, sight):
+        # Catch up with the food eaten elsewhere, regrown and added from
+        # outside since the last tick (`changes`: the cells and what they hold
+        # now), or take a new, larger block of it, then run one tick
+        if food is not None:
+            self.hold(*food)
+        self.food.set(*changes)
+        self.sight = sight
+        self.organisms = by_uid(take(self.organisms, slice(None)), migrants, ghosts)
+        self.ghosts = np.isin(self.organisms.uid, ghosts["uid"])
+        self.eaten = [np.zeros((0, 3), dtype=np.int64)]
+        self.parents = np.zeros(0, dtype=np.int64)
+
+        self.update()
+        self.organisms.keep(~np.isin(self.organisms.uid, ghosts["uid"]))
+
+        events = list(self.telemetry.event_rows)
+        self.telemetry.event_rows.clear()
+        fights, self.renderer.fights = self.renderer.fights, []
+        radius = self.organisms.radius_of_sight
+        return {
+            "eaten": np.concatenate(self.eaten),
+            "parents": self.parents,
+            "events": events,
+            "fights": fights,
+            "organisms": len(self.organisms),
+            "sight": float(radius.max()) if len(radius) else 0.0,
+            "counters": {name: getattr(self, name) for name in COUNTERS},
+            "dead_colors_counter": self.dead_colors_counter,
+        }
+
+    def exchange(self, child_uids, margin):
+        # Number the children, hand over organisms that left the box and
+        # return those close enough to another tile to be its ghosts
+        pop = self.organisms
+        pop.uid[pop.uid < 0] = child_uids
+        self.margin = margin
+        leaving = tile_of(pop.position, self.edges, self.tiles) != self.tile
+        emigrants = take(pop, leaving)
+        pop.keep(~leaving)
+        position = pop.position
+        inner_low = np.where(self.low > 0, self.low + margin, -np.inf)
+        inner_high = np.where(self.high < self.size, self.high - margin, np.inf)
+        border = np.any((position < inner_low) | (position >= inner_high), axis=1)
+        return take(pop, border), emigrants
+
+    def gather(self):
+        return take(self.organisms, slice(None))
+
+
+def serve(connection, tile, tiles, key, ticks, food, config):
+    world = TileWorld(tile, tiles, key, ticks, food, **config)
+    while True:
+        try:
+            command, args = connection.recv()
+        except EOFError:
+            return
+        if command == "close":
+            return
+        connection.send(getattr(world, command)(*args))
+
+
+class TiledWorld:
+    # A VectorGameWorld split into a grid of `tiles` = (x, y, z) boxes, each
+    # simulated by a worker process (TileWorld). Every tick the workers run
+    # their tiles in parallel, then the coordinator passes on the food cells
+    # that changed, numbers the children, moves organisms that crossed into
+    # another box and sends each tile its ghosts. The result is the same as
+    # running the VectorGameWorld in one process with the same seed, and
+    # snapshots are VectorGameWorld snapshots. The coordinator keeps the food
+    # field and the counters; `organisms` collects the population from the
+    # workers, so it is slow and meant for the end of a run.
+
+    def __init__(self, tiles=None, world=None, renderer=None, telemetry=None, **config):
+        self.world = world if world is not None else VectorGameWorld(renderer=renderer, telemetry=telemetry,
+                                                                     **config)
+        world = self.world
+        self.tiles = tuple(tiles or (os.cpu_count() or 1, 1, 1))
+        self.tile_count = int(np.prod(self.tiles))
+        self.edges = tile_edges(world.size, self.tiles)
+        self.boxes = [tile_box(tile, world.size, self.tiles) for tile in range(self.tile_count)]
+        self.ticks = world.ticks
+        self.next_uid = world.next_uid
+        self.base_counters = {name: getattr(world, name) for name in COUNTERS}
+        self.base_colors = dict(world.dead_colors_counter)
+
+        population = world.organisms
+        owner = tile_of(population.position, self.edges, self.tiles)
+        self.sight = float(population.radius_of_sight.max()) if len(population) else 0.0
+        # How far around its box a tile holds the food: its ghosts are up to
+        # three sight radii away and see one more, and a fifth keeps room for
+        # the sight to grow before the tiles need larger blocks
+        self.reach = 5 * self.sight
+        self.connections = []
+        self.processes = []
+        for tile in range(self.tile_count):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=serve, daemon=True, args=(
+                child, tile, self.tiles, world.key, world.ticks, self.food_block(tile), world.config()))
+            process.start()
+            child.close()
+            connection.send(("adopt", (take(population, owner == tile),)))
+            self.connections.append(connection)
+            self.processes.append(process)
+        for connection in self.connections:
+            connection.recv()
+        world.organisms = Population()
+
+        self.population = len(population)
+        # Food cells eaten, regrown or filled since the tiles last heard
+        self.changed = [np.zeros((0, 3), dtype=np.int64)]
+        self.exchange([np.zeros(0, dtype=np.int64)] * self.tile_count)
+
+        self.scheduler = Scheduler(world.timestep)
+        self.scheduler.steps = self.ticks
+        self.scheduler.every(world.timestep, self.update)
+        self.scheduler.every(world.food_interval, self.grow_food)
+
+    def __getattr__(self, name):
+        # Configuration, food and counters live on the coordinator's world
+        world = self.__dict__.get("world")
+        if world is None:
+            raise AttributeError(name)
+        return getattr(world, name)
+
+    def call(self, command, args):
+        for connection, tile_args in zip(self.connections, args):
+            connection.send((command, tile_args))
+        return [connection.recv() for connection in self.connections]
+
+    def update(self):
+        world = self.world
+        blocks = [None] * self.tile_count
+        if 4 * self.sight > self.reach:
+            self.reach = 5 * self.sight
+            blocks = [self.food_block(tile) for tile in range(self.tile_count)]
+        changed = np.unique(np.concatenate(self.changed), axis=0)
+        changes = (changed, world.food.get(changed))
+        results = self.call("step", [(changes, block, ghosts, migrants, self.sight)
+                                     for block, ghosts, migrants in zip(blocks, self.ghosts, self.migrants)])
+        eaten = np.concatenate([result["eaten"] for result in results])
+        world.food.set(eaten, 0)
+        self.changed = [eaten]
+
+        for name in COUNTERS:
+            setattr(world, name, self.base_counters[name] + sum(result["counters"][name] for result in results))
+        world.dead_colors_counter = dict(self.base_colors)
+        for result in results:
+            for color, count in result["dead_colors_counter"].items():
+                world.dead_colors_counter[color] = world.dead_colors_counter.get(color, 0) + count
+            for row in result["events"]:
+                world.telemetry.event(*row)
+            for x, y, z in result["fights"]:
+                self.renderer.mark_fight(x, y, z)
+        self.population = sum(result["organisms"] for result in results)
+        self.sight = max(result["sight"] for result in results)
+        world.ticks = self.ticks
+        world.update_counters(self.population)
+
+        # Children are numbered in the order of their parents' uids, as in one process
+        parents = np.sort(np.concatenate([result["parents"] for result in results]))
+        child_uids = [self.next_uid + np.searchsorted(parents, result["parents"]) for result in results]
+        self.next_uid += len(parents)
+        self.exchange(child_uids)
+        self.ticks += 1
+        world.ticks = self.ticks
+
+    def exchange(self, child_uids):
+        margin = 3 * self.sight
+        results = self.call("exchange", [(uids, margin) for uids in child_uids])
+        moving = {name: np.concatenate([part[name] for result in results for part in result])
+                  for name in results[0][0]}
+        emigrant = np.concatenate([np.repeat([False, True], [len(border["uid"]), len(emigrants["uid"])])
+                                   for border, emigrants in results])
+        owner = tile_of(moving["position"], self.edges, self.tiles)
+        self.ghosts, self.migrants = [], []
+        for tile, (low, high) in enumerate(self.boxes):
+            near = np.all((moving["position"] >= low - margin) & (moving["position"] < high + margin), axis=1)
+            self.ghosts.append({name: values[near & (owner != tile)] for name, values in moving.items()})
+            self.migrants.append({name: values[emigrant & (owner == tile)] for name, values in moving.items()})
+
+    def food_block(self, tile):
+        # Position and amounts of the food cells within reach of a tile's box
+        low, high = self.boxes[tile]
+        size = self.world.cell_size
+        first = np.maximum(0, (low - self.reach) // size).astype(int)
+        last = np.minimum(self.world.food.shape, (high + self.reach) // size + 1).astype(int)
+        return first, self.world.food.block(first, last)
+
+    def grow_food(self):
+        self.changed.append(self.world.grow_food())
+
+    def add_food(self, cells):
+        # Filled here now and in the tiles at the start of the next tick
+        cells = np.asarray(cells, dtype=np.int64).reshape(-1, 3)
+        self.world.food.fill(cells)
+        self.changed.append(cells)
+
+    def tick(self):
+        self.scheduler.step()
+
+    @property
+    def organisms(self):
+        # Including those on their way to another tile
+        return by_uid(*self.call("gather", [()] * self.tile_count), *self.migrants)
+
+    def save_snapshot(self, path):
+        world = self.world
+        world.organisms = self.organisms
+        world.next_uid = self.next_uid
+        try:
+            world.save_snapshot(path)
+        finally:
+            world.organisms = Population()
+
+    @classmethod
+    def load_snapshot(cls, path, renderer=None, telemetry=None, tiles=None):
+        return cls(tiles, world=VectorGameWorld.load_snapshot(path, renderer, telemetry))
+
+    def close(self):
+        for connection, process in zip(self.connections, self.processes):
+            connection.send(("close", ()))
+            connection.close()
+            process.join()
+        self.connections = []
+
+
+# Phases of a tick for profiling.Profiler, as seen by the coordinator: the
+# "tick" phase is mostly waiting for the slowest tile
+PROFILE_PHASES = {
+    "tick": [(TiledWorld, "update")],
+    "exchange": [(TiledWorld, "exchange")],
+    "food regrowth": [(TiledWorld, "grow_food")],
+    "telemetry": [(Telemetry, "tick")],
+}